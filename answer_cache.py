@@ -0,0 +1,142 @@
+"""
+常见问题的回答缓存
+功能：按“助手chat_id + 规范化后的问题”缓存RAGFlow的最终回答和引用文档，
+重复提问时直接回放，不再经过RAGFlow的检索和大模型生成
+"""
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from typing import List, Optional, Tuple
+
+import redis
+
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+# 缓存有效期（秒）
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 3600))
+# 每个助手最多缓存的问题数，超出后淘汰最久未命中的问题
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 500))
+
+# 问题末尾可忽略的标点
+_TRAILING_PUNCTUATION = ".。!！?？~～ "
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """规范化问题文本：统一全角半角、大小写和空白，去掉末尾标点"""
+    question = unicodedata.normalize("NFKC", question).casefold()
+    question = _WHITESPACE.sub(" ", question).strip()
+    return question.rstrip(_TRAILING_PUNCTUATION)
+
+
+class AnswerCache:
+    """
+    基于Redis的回答缓存。
+
+    每个问题的回答存为一个带TTL的字符串键；每个助手另有一个有序集合作为索引，
+    分值为最近一次写入或命中的时间，用于按最久未使用淘汰和按助手整体失效。
+    """
+    def __init__(
+        self,
+        client: redis.Redis,
+        ttl: int = ANSWER_CACHE_TTL,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        namespace: Optional[str] = None,
+    ):
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = namespace or f"{os.getenv('IT_ENVIRONMENT')}:answer_cache"
+
+    def _key(self, chat_id: str, question: str) -> str:
+        digest = hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{chat_id}:{digest}"
+
+    def _index_key(self, chat_id: str) -> str:
+        return f"{self.namespace}:{chat_id}:index"
+
+    def get(self, chat_id: str, question: str) -> Optional[dict]:
+        """
+        查询缓存的回答。
+
+        Returns:
+            命中时返回 {"answer": str, "referenced_docs": [(doc_id, doc_name), ...]}，否则返回None
+        """
+        key = self._key(chat_id, question)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(key)
+            # 命中时刷新索引中的访问时间（xx：只更新已存在的成员）
+            pipe.zadd(self._index_key(chat_id), {key: time.time()}, xx=True)
+            raw, _ = pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"读取回答缓存失败: {e}")
+            return None
+
+        if raw is None:
+            metrics.incr("answer_cache.misses")
+            return None
+        metrics.incr("answer_cache.hits")
+        entry = json.loads(raw)
+        entry["referenced_docs"] = [tuple(doc) for doc in entry["referenced_docs"]]
+        return entry
+
+    def set(self, chat_id: str, question: str, answer: str, referenced_docs: List[Tuple[str, str]]):
+        """写入回答缓存，超出容量时淘汰最久未使用的问题"""
+        key = self._key(chat_id, question)
+        index_key = self._index_key(chat_id)
+        now = time.time()
+        value = json.dumps(
+            {"question": question, "answer": answer, "referenced_docs": referenced_docs},
+            ensure_ascii=False,
+        )
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(key, value, ex=self.ttl)
+            pipe.zadd(index_key, {key: now})
+            # 清理索引中已经过期的问题
+            pipe.zremrangebyscore(index_key, "-inf", now - self.ttl)
+            pipe.expire(index_key, self.ttl)
+            pipe.zcard(index_key)
+            size = pipe.execute()[-1]
+
+            if size > self.max_entries:
+                evicted = [member for member, _ in self.client.zpopmin(index_key, size - self.max_entries)]
+                if evicted:
+                    self.client.delete(*evicted)
+                    metrics.incr("answer_cache.evictions", len(evicted))
+        except redis.RedisError as e:
+            logger.error(f"写入回答缓存失败: {e}")
+
+    def invalidate(self, chat_id: Optional[str] = None) -> int:
+        """
+        使缓存失效，知识库内容变化时调用。
+
+        Args:
+            chat_id: 只清除该助手的缓存；为None时清除所有助手的缓存
+
+        Returns:
+            删除的键数量
+        """
+        deleted = 0
+        if chat_id:
+            index_key = self._index_key(chat_id)
+            keys = self.client.zrange(index_key, 0, -1) + [index_key]
+            deleted = self.client.delete(*keys)
+        else:
+            batch = []
+            for key in self.client.scan_iter(match=f"{self.namespace}:*", count=500):
+                batch.append(key)
+                if len(batch) >= 500:
+                    deleted += self.client.delete(*batch)
+                    batch = []
+            if batch:
+                deleted += self.client.delete(*batch)
+        logger.info(f"回答缓存已失效: chat_id={chat_id or '全部'}, 删除{deleted}个键")
+        return deleted
@@ -0,0 +1,108 @@
+"""
+RAGFlow流式响应解析微基准测试
+对比旧的逐行解析循环与RAGFlowStreamParser在长回答下的耗时
+
+用法：
+    python benchmarks/bench_stream_parser.py [--lengths 2000 10000 50000] [--token-size 4] [--repeat 3]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ragflow_stream import RAGFlowStreamParser  # noqa: E402
+
+
+def build_stream(answer_length: int, token_size: int, doc_count: int = 10) -> bytes:
+    """构造RAGFlow风格的SSE响应：每个事件携带截至目前的完整answer和reference"""
+    reference = {
+        "doc_aggs": [{"doc_id": f"doc{i}", "doc_name": f"文档{i}.pdf", "count": 1} for i in range(doc_count)]
+    }
+    text = ("员工可以通过自助服务门户重置密码。" * (answer_length // 16 + 1))[:answer_length]
+    events = []
+    for end in range(token_size, answer_length + token_size, token_size):
+        payload = {"code": 0, "data": {"answer": text[:end], "reference": reference}}
+        events.append(f"data:{json.dumps(payload, ensure_ascii=False)}\n\n")
+    events.append('data:{"code": 0, "data": true}\n\n')
+    return "".join(events).encode("utf-8")
+
+
+def iter_chunks(body: bytes, chunk_size: int = 4096):
+    for i in range(0, len(body), chunk_size):
+        yield body[i:i + chunk_size]
+
+
+def legacy_parse(body: bytes):
+    """旧实现：逐行lstrip，与已发送内容整串比较，每个事件重新遍历reference"""
+    sent_content = ""
+    referenced_docs = []
+    for line in body.split(b"\n"):
+        if not line:
+            continue
+        try:
+            line = line.decode('utf-8').lstrip('data: ').strip()
+            if not line:
+                continue
+            json_data = json.loads(line)
+            if json_data.get('code') == 0 and json_data.get('data') is True:
+                break
+            if isinstance(json_data.get('data'), dict):
+                answer_chunk = json_data['data'].get('answer', '')
+                reference_data = json_data['data'].get('reference') or {}
+                for doc_info in reference_data.get('doc_aggs', []):
+                    if doc_info.get('doc_id') and doc_info.get('doc_name'):
+                        referenced_docs.append((doc_info['doc_id'], doc_info['doc_name']))
+                if answer_chunk and answer_chunk != sent_content:
+                    new_content = answer_chunk[len(sent_content):]
+                    if new_content:
+                        sent_content = answer_chunk
+        except json.JSONDecodeError:
+            continue
+    return sent_content, referenced_docs
+
+
+def parser_parse(body: bytes):
+    parser = RAGFlowStreamParser()
+    for chunk in iter_chunks(body):
+        parser.feed(chunk)
+        if parser.finished:
+            break
+    else:
+        parser.close()
+    return parser.answer, parser.referenced_docs()
+
+
+def best_of(func, body: bytes, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(body)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--lengths", type=int, nargs="+", default=[2000, 10000, 30000])
+    arg_parser.add_argument("--token-size", type=int, default=4, help="每个事件新增的字符数")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    print(f"{'answer_len':>10} {'events':>8} {'body_MB':>8} {'legacy_ms':>10} {'parser_ms':>10} {'legacy_refs':>11} {'parser_refs':>11}")
+    for length in args.lengths:
+        body = build_stream(length, args.token_size)
+        legacy_answer, legacy_refs = legacy_parse(body)
+        parser_answer, parser_refs = parser_parse(body)
+        assert legacy_answer == parser_answer, "解析结果不一致"
+        legacy_ms = best_of(legacy_parse, body, args.repeat) * 1000
+        parser_ms = best_of(parser_parse, body, args.repeat) * 1000
+        events = length // args.token_size + 1
+        print(f"{length:>10} {events:>8} {len(body) / 1e6:>8.1f} {legacy_ms:>10.1f} {parser_ms:>10.1f} "
+              f"{len(legacy_refs):>11} {len(parser_refs):>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+RAGFlowClient流式回答基准测试
+启动本地模拟RAGFlow服务（benchmarks/mock_ragflow_server.py），按不同并发数运行完整的客户端流程
+（领取/创建会话 -> 流式回答 -> 解析 -> token合并），统计：
+
+- 首token延迟（从发出回答请求到收到第一个增量）
+- 每个流的token速率（事件/秒）
+- 每个流消耗的客户端CPU时间（模拟服务运行在独立进程中，不计入）
+- 单个工作进程能支撑的最大并发流数：首token延迟p95不超过--ttft-slo、没有错误、
+  且token速率不低于模拟服务速率的90%的最高并发档位
+
+指定--max-ttft-p95、--max-cpu-ms、--min-concurrency时，任一指标不达标则以非0状态码退出，可用于部署前检查
+
+用法：
+    python benchmarks/bench_streaming_client.py [--concurrency 1 10 50 100 200] [--token-rate 50]
+        [--answer-length 800] [--ttft-slo 1.0] [--base-url http://127.0.0.1:9380]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_ragflow_server import add_settings_arguments  # noqa: E402
+from ragflow_client import RAGFlowClient, CHAT_ASSISTANT_NAME, close_http_session  # noqa: E402
+from ragflow_stream import RAGFlowStreamParser  # noqa: E402
+from token_coalescer import TokenCoalescer  # noqa: E402
+
+MOCK_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_ragflow_server.py")
+
+
+class StreamResult:
+    """单个流的测量结果"""
+    def __init__(self):
+        self.ttft: Optional[float] = None
+        self.duration = 0.0
+        self.deltas = 0
+        self.chars = 0
+        self.frames = 0
+        self.error: Optional[str] = None
+
+    @property
+    def tokens_per_sec(self) -> float:
+        # 首token之后的生成速率
+        streaming = self.duration - (self.ttft or 0)
+        return self.deltas / streaming if streaming > 0 else 0.0
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def run_stream(client: RAGFlowClient, index: int) -> StreamResult:
+    result = StreamResult()
+
+    async def sink(text: str):
+        result.frames += 1
+
+    try:
+        session_id = await client.create_chat_session(f"chaint_session:bench-{index}")
+        parser = RAGFlowStreamParser()
+        start = time.perf_counter()
+        async with TokenCoalescer(sink) as coalescer:
+            async for delta in client.iter_chat_completion("如何重置密码", session_id, f"bench-{index}", parser):
+                if result.ttft is None:
+                    result.ttft = time.perf_counter() - start
+                result.deltas += 1
+                result.chars += len(delta)
+                await coalescer.push(delta)
+        parser.referenced_docs()
+        result.duration = time.perf_counter() - start
+        if not parser.finished:
+            result.error = "stream ended without data:true"
+    except Exception as e:
+        result.error = type(e).__name__
+    return result
+
+
+async def run_level(base_url: str, concurrency: int) -> dict:
+    client = RAGFlowClient("mock-api-key", base_url)
+    await client.get_chat_id(CHAT_ASSISTANT_NAME)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    results = await asyncio.gather(*(
+        run_stream(RAGFlowClient("mock-api-key", base_url), i) for i in range(concurrency)
+    ))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    ok = [r for r in results if r.error is None]
+    errors = [r.error for r in results if r.error is not None]
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    rates = [r.tokens_per_sec for r in ok]
+    return {
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "error_kinds": sorted(set(errors)),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "tokens_per_sec": sum(rates) / len(rates) if rates else 0.0,
+        "cpu_ms_per_stream": cpu * 1000 / concurrency,
+        "frames_per_stream": sum(r.frames for r in ok) / len(ok) if ok else 0.0,
+        "wall_seconds": wall,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_up(base_url: str, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{base_url}/api/v1/chats") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.1)
+
+
+def start_mock_server(args: argparse.Namespace) -> Tuple[subprocess.Popen, str]:
+    port = free_port()
+    command = [
+        sys.executable, MOCK_SERVER, "--port", str(port),
+        "--token-rate", str(args.token_rate), "--token-size", str(args.token_size),
+        "--answer-length", str(args.answer_length), "--first-token-latency", str(args.first_token_latency),
+        "--request-latency", str(args.request_latency), "--error-rate", str(args.error_rate),
+        "--disconnect-rate", str(args.disconnect_rate), "--doc-count", str(args.doc_count),
+    ]
+    return subprocess.Popen(command), f"http://127.0.0.1:{port}"
+
+
+async def run(args: argparse.Namespace, base_url: str) -> List[dict]:
+    await wait_until_up(base_url)
+    print(f"{'streams':>7} {'errors':>6} {'ttft_p50':>9} {'ttft_p95':>9} {'tok/s':>7} "
+          f"{'cpu_ms':>7} {'frames':>7} {'wall_s':>7}")
+    levels = []
+    try:
+        for concurrency in args.concurrency:
+            level = await run_level(base_url, concurrency)
+            levels.append(level)
+            print(f"{level['concurrency']:>7} {level['errors']:>6} {level['ttft_p50']:>9.3f} "
+                  f"{level['ttft_p95']:>9.3f} {level['tokens_per_sec']:>7.1f} {level['cpu_ms_per_stream']:>7.1f} "
+                  f"{level['frames_per_stream']:>7.1f} {level['wall_seconds']:>7.1f}"
+                  + (f"  {', '.join(level['error_kinds'])}" if level['errors'] else ""))
+    finally:
+        await close_http_session()
+    return levels
+
+
+def healthy(level: dict, args: argparse.Namespace) -> bool:
+    rate_ok = args.token_rate <= 0 or level["tokens_per_sec"] >= 0.9 * args.token_rate
+    return level["errors"] == 0 and level["ttft_p95"] <= args.ttft_slo and rate_ok
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    arg_parser.add_argument("--base-url", help="使用已运行的模拟服务，不指定时自动启动")
+    arg_parser.add_argument("--ttft-slo", type=float, default=1.0, help="判断并发档位是否健康的首token延迟p95（秒）")
+    arg_parser.add_argument("--max-ttft-p95", type=float, help="任一档位首token延迟p95超过该值（秒）时失败")
+    arg_parser.add_argument("--max-cpu-ms", type=float, help="任一档位每个流的CPU时间超过该值（毫秒）时失败")
+    arg_parser.add_argument("--min-concurrency", type=int, help="最大健康并发低于该值时失败")
+    add_settings_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server, base_url = start_mock_server(args)
+    try:
+        levels = asyncio.run(run(args, base_url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    healthy_levels = [level["concurrency"] for level in levels if healthy(level, args)]
+    max_concurrency = max(healthy_levels, default=0)
+    print(f"\n最大健康并发流数: {max_concurrency}（ttft_p95 <= {args.ttft_slo}s，无错误，token速率达标）")
+
+    failures = []
+    if args.max_ttft_p95 is not None:
+        failures += [f"{level['concurrency']}并发 ttft_p95={level['ttft_p95']:.3f}s"
+                     for level in levels if not level["ttft_p95"] <= args.max_ttft_p95]
+    if args.max_cpu_ms is not None:
+        failures += [f"{level['concurrency']}并发 cpu_ms={level['cpu_ms_per_stream']:.1f}"
+                     for level in levels if level["cpu_ms_per_stream"] > args.max_cpu_ms]
+    if args.min_concurrency is not None and max_concurrency < args.min_concurrency:
+        failures.append(f"最大健康并发{max_concurrency} < {args.min_concurrency}")
+    if failures:
+        print("性能回归: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
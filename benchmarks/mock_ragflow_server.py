@@ -0,0 +1,164 @@
+"""
+本地模拟RAGFlow服务
+实现RAGFlowClient用到的接口（查询助手、创建/重命名会话、流式回答），
+用于在不访问真实RAGFlow的情况下压测客户端
+
+流式回答与RAGFlow格式一致：每个事件携带截至目前的完整answer，
+最后一个回答事件携带reference.doc_aggs，最后以data:true结束
+
+用法：
+    python benchmarks/mock_ragflow_server.py [--port 9380] [--token-rate 50] [--answer-length 800]
+        [--first-token-latency 0.3] [--error-rate 0.0] [--disconnect-rate 0.0]
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from typing import Dict
+
+from aiohttp import web
+
+MOCK_CHAT_ID = "mock-chat-id"
+ANSWER_TEXT = "员工可以通过自助服务门户重置域账号密码，如仍无法登录请联系IT服务台。"
+
+
+class MockSettings:
+    """模拟服务的行为参数"""
+    def __init__(
+        self,
+        token_rate: float = 50,
+        token_size: int = 4,
+        answer_length: int = 800,
+        first_token_latency: float = 0.3,
+        request_latency: float = 0.01,
+        error_rate: float = 0.0,
+        disconnect_rate: float = 0.0,
+        doc_count: int = 5,
+    ):
+        # 每秒产生的事件数（每个事件新增token_size个字符）
+        self.token_rate = token_rate
+        self.token_size = token_size
+        self.answer_length = answer_length
+        # 收到回答请求到第一个事件之间的延迟（模拟检索和大模型首token延迟）
+        self.first_token_latency = first_token_latency
+        # 非流式接口的响应延迟
+        self.request_latency = request_latency
+        # 回答请求直接返回500的概率
+        self.error_rate = error_rate
+        # 回答进行到一半时断开连接的概率
+        self.disconnect_rate = disconnect_rate
+        self.doc_count = doc_count
+
+
+def _answer(length: int) -> str:
+    return (ANSWER_TEXT * (length // len(ANSWER_TEXT) + 1))[:length]
+
+
+def _sse(payload) -> bytes:
+    return f"data:{json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def create_app(settings: MockSettings) -> web.Application:
+    """创建模拟RAGFlow的aiohttp应用"""
+    sessions: Dict[str, str] = {}
+    answer = _answer(settings.answer_length)
+    reference = {
+        "doc_aggs": [
+            {"doc_id": f"mock-doc-{i}", "doc_name": f"IT服务手册{i}.pdf", "count": 1}
+            for i in range(settings.doc_count)
+        ]
+    }
+
+    async def list_chats(request: web.Request) -> web.Response:
+        await asyncio.sleep(settings.request_latency)
+        name = request.query.get("name", "AI-assist")
+        return web.json_response({"code": 0, "data": [{"id": MOCK_CHAT_ID, "name": name}]})
+
+    async def create_session(request: web.Request) -> web.Response:
+        await asyncio.sleep(settings.request_latency)
+        body = await request.json()
+        session_id = uuid.uuid4().hex
+        sessions[session_id] = body.get("name", "")
+        return web.json_response({"code": 0, "data": {"id": session_id, "name": sessions[session_id]}})
+
+    async def rename_session(request: web.Request) -> web.Response:
+        await asyncio.sleep(settings.request_latency)
+        session_id = request.match_info["session_id"]
+        if session_id not in sessions:
+            return web.json_response({"code": 102, "message": "会话不存在"})
+        sessions[session_id] = (await request.json()).get("name", "")
+        return web.json_response({"code": 0})
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if body.get("session_id") not in sessions:
+            return web.json_response({"code": 102, "message": "会话不存在"})
+        if random.random() < settings.error_rate:
+            return web.Response(status=500, text="injected error")
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream; charset=utf-8"})
+        await response.prepare(request)
+        await asyncio.sleep(settings.first_token_latency)
+        disconnect_at = len(answer) // 2 if random.random() < settings.disconnect_rate else None
+        interval = 1 / settings.token_rate if settings.token_rate > 0 else 0
+        for end in range(settings.token_size, len(answer) + settings.token_size, settings.token_size):
+            end = min(end, len(answer))
+            if disconnect_at is not None and end >= disconnect_at:
+                # 模拟上游异常中断：不发送结束事件直接断开
+                request.transport.close()
+                return response
+            last = end == len(answer)
+            data = {"answer": answer[:end], "reference": reference if last else {}}
+            await response.write(_sse({"code": 0, "data": data}))
+            if interval and not last:
+                await asyncio.sleep(interval)
+        await response.write(_sse({"code": 0, "data": True}))
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get("/api/v1/chats", list_chats)
+    app.router.add_post("/api/v1/chats/{chat_id}/sessions", create_session)
+    app.router.add_put("/api/v1/chats/{chat_id}/sessions/{session_id}", rename_session)
+    app.router.add_post("/api/v1/chats/{chat_id}/completions", completions)
+    return app
+
+
+def add_settings_arguments(arg_parser: argparse.ArgumentParser):
+    """把MockSettings的参数加入命令行（供基准测试脚本复用）"""
+    defaults = MockSettings()
+    arg_parser.add_argument("--token-rate", type=float, default=defaults.token_rate, help="每秒事件数，0表示不限速")
+    arg_parser.add_argument("--token-size", type=int, default=defaults.token_size, help="每个事件新增的字符数")
+    arg_parser.add_argument("--answer-length", type=int, default=defaults.answer_length)
+    arg_parser.add_argument("--first-token-latency", type=float, default=defaults.first_token_latency)
+    arg_parser.add_argument("--request-latency", type=float, default=defaults.request_latency)
+    arg_parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    arg_parser.add_argument("--disconnect-rate", type=float, default=defaults.disconnect_rate)
+    arg_parser.add_argument("--doc-count", type=int, default=defaults.doc_count)
+
+
+def settings_from_args(args: argparse.Namespace) -> MockSettings:
+    return MockSettings(
+        token_rate=args.token_rate,
+        token_size=args.token_size,
+        answer_length=args.answer_length,
+        first_token_latency=args.first_token_latency,
+        request_latency=args.request_latency,
+        error_rate=args.error_rate,
+        disconnect_rate=args.disconnect_rate,
+        doc_count=args.doc_count,
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=9380)
+    add_settings_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    web.run_app(create_app(settings_from_args(args)), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
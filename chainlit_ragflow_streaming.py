@@ -19,15 +19,29 @@ import chainlit as cl
 from typing import Optional
 import logging
 import uuid
-from message_queue import RedisQueue
+from queue_backend import create_queue, create_async_queue
+from stream_dispatcher import StreamDispatcher
+from session_directory import create_session_directory
+from retention import SESSION_METADATA_TTL, HANDOFF_ENDED_STREAM_TTL
 from ragflow_client import RAGFlowClient
+from completion_scheduler import completion_scheduler, SchedulerBusyError
+from resilience import CircuitOpenError
+from answer_cache import AnswerCache, ANSWER_CACHE_ENABLED
+from starters import STARTERS
 # import session_utils
 # 配置日志
 from logger_config import setup_logger
 logger = setup_logger(__name__)
 
-# 初始化Redis队列
-redis_queue = RedisQueue()
+# 初始化消息队列（QUEUE_BACKEND选择Redis或进程内实现）
+redis_queue = create_queue()
+# 异步消息队列：人工客服消息的阻塞读取等在事件循环上，不占用线程池
+async_redis_queue = create_async_queue()
+# 本工作进程所有转人工会话共用的消息流分发器（一个XREAD读取全部会话的消息流）
+# 启用会话目录时只读取本工作进程的收件箱，收到通知后再读取对应会话的消息流
+stream_dispatcher = StreamDispatcher(async_redis_queue, directory=create_session_directory(async_redis_queue))
+# 常见问题回答缓存（与消息队列共用Redis连接；进程内队列没有Redis连接，不启用）
+answer_cache = AnswerCache(redis_queue.client) if ANSWER_CACHE_ENABLED and redis_queue.client is not None else None
 
 # 全局消息队列: Chainlit会话ID -> 消息队列
 message_queues = {}
@@ -156,6 +170,9 @@ async def on_action(action: cl.Action):
         formatted_history = '\n\n'.join([f'**{msg["role"].capitalize()}: **{msg["content"]}' for msg in cl.chat_context.to_openai()])
         message_content = f"[CHAINLIT_USER_ID:{app_user.identifier}]\n{formatted_history}"
 
+        # 在发送转人工消息之前记录消息流的读取位置，之后客服的所有回复都会被投递
+        stream_cursor = await async_redis_queue.stream_cursor_now()
+
         # 发送消息到Rocket.Chat
         # pprint(rocket.chat_post_message(message_content, channel=f'@{recipient}').json())
         post_response = rocket.chat_post_message(
@@ -181,24 +198,32 @@ async def on_action(action: cl.Action):
         cl.user_session.set("rocket_chat_recipient", recipient)
         cl.user_session.set("rocket_chat_room_id", room_id)
         cl.user_session.set("rocket_chat_client", rocket)
+        cl.user_session.set("rocket_chat_stream_cursor", stream_cursor)
+
+        # 启动人工客服消息投递任务（只有转人工的会话才读取消息流；重复转人工时替换之前的任务）
+        queue_name = f"{os.getenv("IT_ENVIRONMENT")}:rocket.chat_session:{recipient}:{room_id}:messages_queue"
+        await stop_message_task()
+        message_task = asyncio.create_task(process_messages(chainlit_session_id, queue_name, stream_cursor))
+        cl.user_session.set("message_task", message_task)
+        cl.user_session.set("rocket_chat_queue_name", queue_name)
 
         # 更新Redis会话元数据（存储room_id用于消息路由）
-        redis_queue.client.hset(
+        await async_redis_queue.hset(
             f"chainlit_session:{username}:{chainlit_session_id}:metadata",
-            mapping={
+            {
                 "room_id": room_id,
                 "status": "human_chat", 
                 "support_agent": recipient, 
                 "chainlit_session_id": chainlit_session_id, 
-                "用户点击转人工的时间": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
+                "用户点击转人工的时间": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                },
+            ttl=SESSION_METADATA_TTL,
         )
-        # 打印当前所有消息队列状态（调试用）
-        all_queues = redis_queue.get_all_queues()
-        # queue_status = {q: redis_queue.qsize(q) for q in all_queues}
-        queue_status = {q: redis_queue.qsize(q) for q in all_queues}
-        logger.info(f"【debug】当前消息队列状态: {queue_status}")
-        logger.info(f"【debug】RedisQueue实例ID: {id(redis_queue)}")
+        # 只在DEBUG级别查询本会话的消息流状态（调试用），转人工时不遍历全部队列
+        if logger.isEnabledFor(logging.DEBUG):
+            exists = await async_redis_queue.queue_exists(queue_name)
+            size = await async_redis_queue.qsize(queue_name) if exists else 0
+            logger.debug(f"【debug】消息流状态: {queue_name}, 已登记: {exists}, 消息数: {size}")
         """
     except RocketChatException as e:
         logger.error(f"【debug】Rocket.Chat API错误: {str(e)}", exc_info=True)
@@ -216,8 +241,10 @@ async def on_chat_start():
     try:
         # 创建并存储RAGFlow客户端实例
         logger.info(f"【debug】CHAT_ASSISTANT_NAME的值为: {CHAT_ASSISTANT_NAME}")
-        rag_client = RAGFlowClient(API_KEY, BASE_URL)
-        rag_client.get_chat_id(CHAT_ASSISTANT_NAME)  # 验证助手是否存在
+        rag_client = RAGFlowClient(
+            API_KEY, BASE_URL, answer_cache=answer_cache, scheduler=completion_scheduler
+        )
+        await rag_client.get_chat_id(CHAT_ASSISTANT_NAME)  # 验证助手是否存在
         cl.user_session.set("rag_client", rag_client)
         # 初始化会话状态变量
         cl.user_session.set("is_human_session", False)
@@ -257,23 +284,20 @@ async def on_chat_start():
         session_id = cl.user_session.get("id")
         user_info = cl.user_session.get("user")
         user_id = user_info.identifier if user_info else "anonymous"
-        redis_queue.client.hset(
+        # 写入元数据并设置会话过期时间，在一次往返中完成
+        await async_redis_queue.hset(
             f"chainlit_session:{app_user.identifier}:{session_id}:metadata",
-            mapping={
+            {
                 "user_id": user_id,
                 "mail": app_user.identifier,
                 "chainlit_session_id": session_id,
                 "created_at": datetime.datetime.now().isoformat(),
                 "status": "active"
-            }
+            },
+            ttl=SESSION_METADATA_TTL,
         )
-        # 设置会话过期时间（24小时）
-        redis_queue.client.expire(f"chainlit_session:{user_id}:{session_id}:metadata", 86400)
-
-        
-        # 启动消息处理任务并保存引用
-        message_task = asyncio.create_task(process_messages(session_id))
-        cl.user_session.set("message_task", message_task)
+        # 人工客服消息投递任务在转人工（on_action）时才启动
+        cl.user_session.set("message_task", None)
 
     except Exception as e:
         await cl.Message(content=f"初始化失败: {str(e)}").send()
@@ -308,114 +332,52 @@ async def on_chat_start():
             break
     """
 
-async def process_messages(session_id: str):
+async def process_messages(session_id: str, queue_name: str, cursor: str):
     """
-    这个函数主要负责从Redis队列中读取消息并发送到Chainlit。
-    参数session_id指的是chainlit中的会话ID。
-    它会根据会话ID动态获取对应的消息队列名称，并在队列中读取消息。
-    如果读取到消息，会将其发送到Chainlit进行展示；如果读取超时或队列空，会进行适当的日志记录。
-    这个函数被on_chat_start调用。
+    这个函数主要负责把人工客服的回复从Redis消息流投递到Chainlit。
+    参数session_id指的是chainlit中的会话ID，queue_name是客服回复所在的消息流，cursor是开始投递的位置（转人工时记录）。
+    它在分发器中登记订阅，收到消息后发送到Chainlit进行展示，并在用户会话中记录最后投递的消息ID。
+    这个函数由on_action在转人工后启动、在on_chat_end时取消；没有转人工的会话不运行它，也不产生任何Redis访问。
     """
-
-    while True:
-        try:
-            # 动态获取当前room_id（支持转人工后更新）
-            # current_room_id = redis_queue.client.hget(metadata_key, "room_id") or room_id
-            # if current_room_id != room_id:
-            #     logger.info(f"【debug】房间ID变更: {room_id} -> {current_room_id}")
-            #     room_id = current_room_id
-            #     queue_name = f"session:{room_id}:metadata"
-            # if not room_id:
-            #     # 未进入人工会话，使用默认队列
-                
-            #     queue_name = f"session:{session_id}"
-            #     logger.info(f"【debug】未进入人工会话，使用默认队列: {queue_name}")
-            #     await asyncio.sleep(5)  # 降低空轮询频率
-            #     continue
-               # 从Redis获取room_id
-            metadata_queue_name = f"chainlit_session:{cl.user_session.get("user").identifier}:{session_id}:metadata"
-            # logger.info(f"【debug】尝试从Redis获取会话元数据: {metadata_queue_name}")
-            metadata = redis_queue.client.hgetall(metadata_queue_name)
-            # logger.info(f"【debug】获取到的会话元数据: {metadata}")
-
-
-            # Get room_id with proper error handling
-            # room_id = metadata.get("room_id")
-            # logger.info(f"【debug】从会话元数据中获取room_id: {room_id}")
-            room_id = cl.user_session.get("rocket_chat_room_id")
-            logger.info(f"【debug】从用户会话中获取rocket_chat_room_id: {room_id}")
-            if room_id is None:
-                logger.warning(f"【警告】会话 {session_id} 的元数据中未找到 room_id这个key，说明此用户没有选择人工客服。使用默认值")
-                room_id = "不存在room_id，此用户没有选择人工客服"
-            logger.info(f"【debug】消息处理初始化 - 会话ID: {session_id}, 房间ID: {room_id}")
-
-            if room_id == "不存在room_id，此用户没有选择人工客服":
-                # 未进入人工会话，使用默认队列
-                logger.info(f"【debug】此用户 {cl.user_session.get("user").identifier}---{session_id} 没有选择人工客服，未进入人工会话，不读取消息")
-                await asyncio.sleep(5)  # 降低空轮询频率
-                continue
-            else:
-                queue_name = f"{os.getenv("IT_ENVIRONMENT")}:rocket.chat_session:{cl.user_session.get("rocket_chat_recipient")}:{room_id}:messages_queue"
-                logging.info(f"【debug】此用户{cl.user_session.get("user").identifier}--- {session_id} 选择了人工客服，使用队列: {queue_name}")
-
-            logger.info(f"【debug】尝试从Redis队列 {queue_name} 读取消息")
-
-            # message = await asyncio.to_thread(
-            #     redis_queue.dequeue,
-            #     queue_name,
-            #     block=True,
-            #     timeout=30
-            # )
-            # 从redis消息队列中弹出最新的一条消息，同时不删除消息
-            data = await asyncio.to_thread(
-                redis_queue.stream_peek_latest,
-                queue_name,
-                block=True,
-                timeout=30
-            )
-            
-
-            if data is None:
-                logger.info(f"【debug】队列 {queue_name} 超时未读取到消息")
-                continue
-            else:
-                message = data['data']['data']
-                logger.info(f"【debug】从队列 {queue_name} 读取到消息: {message}")
+    metadata_queue_name = f"chainlit_session:{cl.user_session.get("user").identifier}:{session_id}:metadata"
+    subscription = stream_dispatcher.subscribe(queue_name, cursor, session_id)
+    logger.info(f"【debug】会话 {session_id} 开始接收人工客服消息，使用队列: {queue_name}")
+    try:
+        while True:
+            # 积压的多条消息一次取回；发送消息期间到达的新消息会留在订阅队列中，不会丢失
+            entries = await subscription.next_batch()
+            for entry in entries:
+                message = entry['message'].body
                 await cl.Message(content=message).send()
-                logger.info(f"【debug】消息已发送到Chainlit用户：{cl.user_session.get("user").identifier}，人工客服：{cl.user_session.get("rocket_chat_recipient")} 房间ID为：{room_id}，消息内容为：{message}")
+                # 本地直接投递的消息还没有消息流ID，游标在之后从Redis读到时推进
+                if entry['id']:
+                    cl.user_session.set("rocket_chat_stream_cursor", entry['id'])
+                logger.info(f"【debug】消息已发送到Chainlit用户：{cl.user_session.get("user").identifier}，人工客服：{cl.user_session.get("rocket_chat_recipient")} 队列为：{queue_name}，消息内容为：{message}")
+            # 有消息往来的会话刷新元数据的过期时间（读取位置在订阅和用户会话中，不写入Redis）
+            await async_redis_queue.expire(metadata_queue_name, SESSION_METADATA_TTL)
+    except asyncio.CancelledError:
+        logger.info(f"【debug】会话 {session_id} 消息处理任务已取消")
+    except Exception as e:
+        logger.error(f"Error processing message for session {session_id}: {str(e)}", exc_info=True)
+    finally:
+        stream_dispatcher.unsubscribe(subscription)
 
-            
+
+async def stop_message_task():
+    """取消当前会话的人工客服消息投递任务（如果存在）"""
+    message_task = cl.user_session.get("message_task")
+    if message_task:
+        message_task.cancel()
+        try:
+            await message_task
         except asyncio.CancelledError:
-            logger.info(f"【debug】会话 {session_id} 消息处理任务已取消")
-            break
-        except Exception as e:
-            logger.error(f"Error processing message for session {session_id}: {str(e)}", exc_info=True)
-            break
+            pass
+        cl.user_session.set("message_task", None)
+    return message_task
 
 @cl.set_starters
 async def set_starters():
-    return [
-        cl.Starter(
-            label="AI助手使用手册",
-            message="AI助手使用手册.",
-            icon="http://10.64.160.146/arrow-right-circle-line.svg",
-        ),
-        cl.Starter(
-            label="如何重置密码",
-            message="如何重置密码.",
-            icon="http://10.64.160.146/arrow-right-circle-line.svg",
-        ),
-        cl.Starter(
-            label="公司食堂开餐时间",
-            message="公司食堂开餐时间.",
-            icon="http://10.64.160.146/arrow-right-circle-line.svg",
-        ),
-        cl.Starter(
-            label="怎么查打卡时间",
-            message="怎么查打卡时间.",
-            icon="http://10.64.160.146/arrow-right-circle-line.svg",
-        )
-    ]
+    return [cl.Starter(**starter) for starter in STARTERS]
 
 @cl.on_message
 async def on_message(message: cl.Message):
@@ -456,7 +418,16 @@ async def on_message(message: cl.Message):
             # AI会话，使用RAGFlow处理
             msg = await cl.Message(content="").send()
             user_identifier = cl.user_session.get("user").identifier
-            await rag_client.stream_chat_completion(message.content, msg)
+            try:
+                await rag_client.stream_chat_completion(message.content, msg)
+            except SchedulerBusyError as e:
+                logger.warning(f"【debug】用户 {user_identifier} 的请求未被受理: {e}")
+                msg.content = "当前咨询人数较多，请稍后再试"
+                await msg.update()
+            except (CircuitOpenError, TimeoutError) as e:
+                logger.warning(f"【debug】RAGFlow暂时不可用，用户 {user_identifier} 的请求失败: {e!r}")
+                msg.content = "AI助手暂时无法回答，请稍后再试"
+                await msg.update()
 
     except Exception as e:
         error_msg = f"处理请求时出错: {str(e)}"
@@ -469,18 +440,18 @@ async def on_chat_end():
     if not chainlit_session_id:
         return
     
-    # 获取消息处理任务并取消
-    message_task = cl.user_session.get("message_task")
-    if message_task:
-        message_task.cancel()
-        try:
-            await message_task
-        except asyncio.CancelledError:
-            pass
-    
-        # 清理Redis队列
-        queue_name = f"chainlit_session:{cl.user_session.get("user").identifier}:{chainlit_session_id}:metadata"
-        redis_queue.clear(queue_name)
-        logger.info(f"chainlit Session {chainlit_session_id} ended. Redis queue {queue_name} cleared.")
-    else:
-        logger.info(f"【debug】会话 {chainlit_session_id} 结束，消息队列不存在")
+    # 取消人工客服消息投递任务（只有转人工的会话才有）
+    if not await stop_message_task():
+        logger.info(f"【debug】会话 {chainlit_session_id} 结束，未转人工，没有消息投递任务")
+
+    # 清理Redis中的会话元数据
+    queue_name = f"chainlit_session:{cl.user_session.get("user").identifier}:{chainlit_session_id}:metadata"
+    await async_redis_queue.clear(queue_name)
+    logger.info(f"chainlit Session {chainlit_session_id} ended. Redis queue {queue_name} cleared.")
+
+    # 人工客服消息流按房间复用（同一客服和用户再次转人工时继续使用），不直接删除，只缩短保留时间；
+    # 客服再次回复时webhook会恢复完整的过期时间
+    stream_name = cl.user_session.get("rocket_chat_queue_name")
+    if stream_name:
+        await async_redis_queue.expire(stream_name, HANDOFF_ENDED_STREAM_TTL)
+        logger.info(f"【debug】会话 {chainlit_session_id} 的人工客服消息流 {stream_name} 将在{HANDOFF_ENDED_STREAM_TTL}秒后过期")
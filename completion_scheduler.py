@@ -0,0 +1,170 @@
+"""
+RAGFlow回答请求的准入控制与公平调度
+功能：限制同时进行的回答数量（全局和每个用户），排队时在用户之间轮转，
+排队超时后返回“繁忙”，保证大模型后端饱和时的延迟可预期
+"""
+import asyncio
+import os
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict
+
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 每个工作进程同时进行的RAGFlow回答数量上限
+MAX_CONCURRENT_COMPLETIONS = int(os.getenv('RAGFLOW_MAX_CONCURRENT_COMPLETIONS', 32))
+# 每个用户同时进行的回答数量上限
+MAX_CONCURRENT_PER_USER = int(os.getenv('RAGFLOW_MAX_CONCURRENT_PER_USER', 1))
+# 每个用户最多排队的请求数，超出时直接返回繁忙
+MAX_QUEUED_PER_USER = int(os.getenv('RAGFLOW_MAX_QUEUED_PER_USER', 3))
+# 最长排队时间（秒）
+MAX_QUEUE_WAIT = float(os.getenv('RAGFLOW_MAX_QUEUE_WAIT', 30))
+
+
+class SchedulerBusyError(Exception):
+    """排队超时或排队人数过多，本次请求未被受理"""
+
+
+class CompletionScheduler:
+    """
+    RAGFlow回答请求调度器。
+
+    - 全局并发不超过max_concurrent，单个用户并发不超过max_per_user；
+    - 需要排队时每个用户一个队列，有空位时在用户之间轮流放行，
+      一个用户连续发送很多问题也不会挤占其他用户；
+    - 排队超过max_queue_wait秒或用户排队数超过max_queued_per_user时抛出SchedulerBusyError。
+
+    用法：
+        async with scheduler.slot(user_id):
+            ...  # 请求RAGFlow
+    """
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_COMPLETIONS,
+        max_per_user: int = MAX_CONCURRENT_PER_USER,
+        max_queued_per_user: int = MAX_QUEUED_PER_USER,
+        max_queue_wait: float = MAX_QUEUE_WAIT,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queue_wait = max_queue_wait
+        self._running_total = 0
+        self._running: Dict[str, int] = {}
+        # 用户 -> 等待中的请求；OrderedDict的顺序即轮转顺序
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._queued_total = 0
+
+    @asynccontextmanager
+    async def slot(self, user_id: str) -> AsyncIterator[None]:
+        """获取一个回答名额，退出上下文时释放"""
+        await self._acquire(user_id)
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    def stats(self) -> dict:
+        """当前调度状态"""
+        return {
+            "running": self._running_total,
+            "queued": self._queued_total,
+            "queued_users": len(self._waiters),
+        }
+
+    def _can_run(self, user_id: str) -> bool:
+        return (
+            self._running_total < self.max_concurrent
+            and self._running.get(user_id, 0) < self.max_per_user
+        )
+
+    def _start(self, user_id: str):
+        self._running_total += 1
+        self._running[user_id] = self._running.get(user_id, 0) + 1
+
+    async def _acquire(self, user_id: str):
+        # 没有人排队时直接放行；有人排队时新请求也要排队，避免插队
+        if not self._waiters and self._can_run(user_id):
+            self._start(user_id)
+            metrics.observe("scheduler.wait_seconds", 0.0)
+            self._update_gauges()
+            return
+
+        queue = self._waiters.get(user_id)
+        if queue is not None and len(queue) >= self.max_queued_per_user:
+            metrics.incr("scheduler.rejected")
+            raise SchedulerBusyError(f"用户{user_id}排队的请求过多")
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.setdefault(user_id, deque()).append(waiter)
+        self._queued_total += 1
+        # 其他用户占着队列时，本用户仍可能有空位可用
+        self._dispatch()
+        started = loop.time()
+        try:
+            await asyncio.wait({waiter}, timeout=self.max_queue_wait)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已被放行但调用者被取消，把名额还回去
+                self._release(user_id)
+            else:
+                self._discard_waiter(user_id, waiter)
+            raise
+        finally:
+            metrics.observe("scheduler.wait_seconds", loop.time() - started)
+
+        if not waiter.done():
+            self._discard_waiter(user_id, waiter)
+            metrics.incr("scheduler.rejected")
+            logger.warning(f"用户{user_id}排队超过{self.max_queue_wait}秒，返回繁忙")
+            raise SchedulerBusyError(f"排队超过{self.max_queue_wait}秒")
+
+    def _discard_waiter(self, user_id: str, waiter: asyncio.Future):
+        waiter.cancel()
+        queue = self._waiters.get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self._queued_total -= 1
+            if not queue:
+                del self._waiters[user_id]
+        self._update_gauges()
+
+    def _release(self, user_id: str):
+        self._running_total -= 1
+        self._running[user_id] -= 1
+        if not self._running[user_id]:
+            del self._running[user_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        """有空位时按用户轮转放行排队的请求"""
+        while self._waiters and self._running_total < self.max_concurrent:
+            admitted = False
+            for user_id in list(self._waiters):
+                if self._running_total >= self.max_concurrent:
+                    break
+                if not self._can_run(user_id):
+                    continue
+                queue = self._waiters.pop(user_id)
+                waiter = queue.popleft()
+                self._queued_total -= 1
+                if queue:
+                    # 该用户移到轮转队尾
+                    self._waiters[user_id] = queue
+                self._start(user_id)
+                waiter.set_result(None)
+                admitted = True
+            if not admitted:
+                break
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.set_gauge("scheduler.running", self._running_total)
+        metrics.set_gauge("scheduler.queued", self._queued_total)
+
+
+# 进程级共享的调度器
+completion_scheduler = CompletionScheduler()
@@ -0,0 +1,476 @@
+"""
+进程内消息队列后端
+功能：用进程内的数据结构实现与RedisQueue/AsyncRedisQueue相同的接口（列表、带长度上限和阻塞读取的消息流、哈希），
+单节点部署（webhook服务和Chainlit运行在同一进程）时省去每条转人工消息的Redis往返，基准测试也不再依赖外部服务。
+通过QUEUE_BACKEND=memory启用（见queue_backend.py）；数据不持久化，进程重启后丢失，也不能在多个工作进程间共享。
+"""
+import asyncio
+import bisect
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from message_codec import LazyMessage, MessageCodec, default_codec
+from message_queue import QUEUE_TYPES, STREAM_READ_COUNT, STREAM_TTL, stream_cursor_from_time
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+StreamId = Tuple[int, int]
+Fields = Dict[bytes, bytes]
+
+
+def _parse_id(stream_id: str) -> StreamId:
+    milliseconds, _, sequence = stream_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+def _format_id(stream_id: StreamId) -> str:
+    return f"{stream_id[0]}-{stream_id[1]}"
+
+
+def _to_bytes(value: Any) -> bytes:
+    return value if isinstance(value, bytes) else str(value).encode("utf-8")
+
+
+class _Stream:
+    """一个消息流：按ID排序的条目"""
+    def __init__(self):
+        self.ids: List[StreamId] = []
+        self.entries: List[Fields] = []
+        self.last_id: StreamId = (0, 0)
+
+    def add(self, fields: Fields, maxlen: int) -> StreamId:
+        milliseconds = int(time.time() * 1000)
+        if milliseconds > self.last_id[0]:
+            self.last_id = (milliseconds, 0)
+        else:
+            self.last_id = (self.last_id[0], self.last_id[1] + 1)
+        self.ids.append(self.last_id)
+        self.entries.append(fields)
+        if maxlen and len(self.ids) > maxlen:
+            del self.ids[:-maxlen]
+            del self.entries[:-maxlen]
+        return self.last_id
+
+    def after(self, cursor: str, count: int) -> List[Tuple[StreamId, Fields]]:
+        start = bisect.bisect_right(self.ids, self.last_id if cursor == "$" else _parse_id(cursor))
+        end = start + count if count else len(self.ids)
+        return list(zip(self.ids[start:end], self.entries[start:end]))
+
+
+class MemoryStore:
+    """
+    进程内数据：列表、消息流、哈希、过期时间和队列索引。
+
+    同一进程中的同步队列（webhook）和异步队列（Chainlit）共用一个MemoryStore，
+    所有修改都在锁内完成，写入后唤醒等待中的阻塞读取（线程和事件循环中的都会被唤醒）。
+    """
+    def __init__(self):
+        self.lists: Dict[str, List[str]] = {}
+        self.streams: Dict[str, _Stream] = {}
+        self.hashes: Dict[str, Dict[str, str]] = {}
+        # 键 -> 过期时间（time.monotonic()）
+        self.expires: Dict[str, float] = {}
+        # 队列类型 -> {队列名称: 最后写入时间}，对应Redis中的队列索引
+        self.registry: Dict[str, Dict[str, float]] = {key_type: {} for key_type in QUEUE_TYPES}
+        self.lock = threading.RLock()
+        self._condition = threading.Condition(self.lock)
+        self._async_waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        # 最近一次清理的结果，供/retention查询
+        self.last_report: Dict[str, dict] = {}
+
+    def expire_key(self, key: str):
+        """惰性过期：访问前删除已过期的键"""
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.delete(key)
+
+    def sweep(self) -> Dict[str, dict]:
+        """
+        删除所有已过期的键，并从队列索引中删除已不存在的队列。
+
+        惰性过期只在访问时删除键，已结束的转人工会话的消息流不会再被访问，
+        需要由后台定期调用（与RetentionSweeper.sweep接口一致，可交给run_retention_loop执行）。
+        """
+        with self.lock:
+            now = time.monotonic()
+            expired = [key for key, deadline in self.expires.items() if deadline <= now]
+            for key in expired:
+                self.delete(key)
+            pruned = 0
+            for registry in self.registry.values():
+                missing = [name for name in registry if name not in self.lists and name not in self.streams]
+                for name in missing:
+                    del registry[name]
+                pruned += len(missing)
+            report = {
+                "memory_store": {
+                    "lists": len(self.lists),
+                    "streams": len(self.streams),
+                    "hashes": len(self.hashes),
+                    "expired": len(expired),
+                },
+                "queue_registry": {"pruned": pruned},
+            }
+        self.last_report = report
+        metrics.set_gauge("retention.memory_store.keys", len(self.lists) + len(self.streams) + len(self.hashes))
+        if expired:
+            metrics.incr("retention.memory_store.expired", len(expired))
+        if pruned:
+            metrics.incr("retention.registry_pruned", pruned)
+        logger.info(f"进程内队列数据清理完成: {report}")
+        return report
+
+    def delete(self, key: str) -> int:
+        self.expires.pop(key, None)
+        deleted = 0
+        for values in (self.lists, self.streams, self.hashes):
+            if values.pop(key, None) is not None:
+                deleted = 1
+        return deleted
+
+    def key_type(self, key: str) -> str:
+        self.expire_key(key)
+        if key in self.lists:
+            return "list"
+        if key in self.streams:
+            return "stream"
+        if key in self.hashes:
+            return "hash"
+        return "none"
+
+    def set_ttl(self, key: str, ttl: Optional[int]):
+        if ttl:
+            self.expires[key] = time.monotonic() + ttl
+
+    def register(self, key_type: str, name: str):
+        self.registry[key_type][name] = time.time()
+
+    def stream(self, name: str) -> Optional[_Stream]:
+        self.expire_key(name)
+        return self.streams.get(name)
+
+    def notify(self):
+        """唤醒所有阻塞读取（调用方需持有锁）"""
+        self._condition.notify_all()
+        for loop, event in list(self._async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def wait(self, check: Callable[[], Any], timeout: Optional[float]) -> Any:
+        """在当前线程中阻塞，直到check()返回真值或超时（timeout为None表示一直等待）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                result = check()
+                if result:
+                    return result
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return result
+                self._condition.wait(remaining)
+
+    async def wait_async(self, check: Callable[[], Any], timeout: Optional[float]) -> Any:
+        """在事件循环中等待，直到check()返回真值或超时（timeout为None表示一直等待）"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self.lock:
+            self._async_waiters.add(waiter)
+        try:
+            while True:
+                # 先登记再检查，检查之后的写入一定会设置event
+                event.clear()
+                with self.lock:
+                    result = check()
+                remaining = None if deadline is None else deadline - loop.time()
+                if result or (remaining is not None and remaining <= 0):
+                    return result
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.lock:
+                self._async_waiters.discard(waiter)
+
+
+# 进程级共享的数据
+memory_store = MemoryStore()
+
+
+def _blocking_timeout(block: bool, timeout: float) -> Optional[float]:
+    """把RedisQueue的block/timeout参数转换为等待时间：0表示不等待，None表示一直等待（与BLPOP/XREAD的0一致）"""
+    if not block:
+        return 0
+    return timeout or None
+
+
+class MemoryQueue:
+    """
+    与RedisQueue接口相同的进程内队列。
+
+    没有Redis连接，client为None；依赖原始Redis客户端的功能（如回答缓存）需要在使用前判断。
+    """
+    def __init__(self, store: Optional[MemoryStore] = None, codec: Optional[MessageCodec] = None):
+        self.store = store or memory_store
+        self.codec = codec or default_codec
+        self.client = None
+
+    # 以下_开头的方法在锁内调用，同步和异步队列共用
+
+    def _enqueue(self, queue_name: str, item: Any) -> int:
+        store = self.store
+        store.expire_key(queue_name)
+        items = store.lists.setdefault(queue_name, [])
+        items.append(str(item))
+        store.register("list", queue_name)
+        store.notify()
+        return len(items)
+
+    def _pop(self, queue_name: str) -> Optional[str]:
+        self.store.expire_key(queue_name)
+        items = self.store.lists.get(queue_name)
+        if not items:
+            return None
+        item = items.pop(0)
+        if not items:
+            del self.store.lists[queue_name]
+        return item
+
+    def _append(self, stream_name: str, fields_list: List[Dict[str, Any]], maxlen: int,
+                ttl: Optional[int]) -> Tuple[List[str], int]:
+        store = self.store
+        stream = store.stream(stream_name)
+        if stream is None:
+            stream = store.streams[stream_name] = _Stream()
+        ids = [
+            _format_id(stream.add({_to_bytes(k): _to_bytes(v) for k, v in fields.items()}, maxlen))
+            for fields in fields_list
+        ]
+        store.set_ttl(stream_name, ttl)
+        store.register("stream", stream_name)
+        store.notify()
+        return ids, len(stream.ids)
+
+    def _read(self, stream_name: str, last_id: str, count: int) -> List[Tuple[StreamId, Fields]]:
+        stream = self.store.stream(stream_name)
+        return stream.after(last_id, count) if stream else []
+
+    def _size(self, queue_name: str) -> int:
+        key_type = self.store.key_type(queue_name)
+        if key_type == "list":
+            return len(self.store.lists[queue_name])
+        if key_type == "stream":
+            return len(self.store.streams[queue_name].ids)
+        logger.warning(f"Unsupported queue type: {key_type} for queue {queue_name}")
+        return 0
+
+    def _clear(self, queue_name: str) -> int:
+        for registry in self.store.registry.values():
+            registry.pop(queue_name, None)
+        return self.store.delete(queue_name)
+
+    def _hset(self, name: str, mapping: Dict[str, Any], ttl: Optional[int]) -> int:
+        self.store.expire_key(name)
+        values = self.store.hashes.setdefault(name, {})
+        added = sum(1 for field in mapping if field not in values)
+        values.update({field: str(value) for field, value in mapping.items()})
+        self.store.set_ttl(name, ttl)
+        return added
+
+    def _hgetall(self, name: str) -> Dict[str, str]:
+        self.store.expire_key(name)
+        return dict(self.store.hashes.get(name, {}))
+
+    def _registered(self, prefix: str, key_type: str) -> list:
+        registry = self.store.registry[key_type]
+        return [name for name in sorted(registry, key=registry.get) if name.startswith(prefix)]
+
+    @staticmethod
+    def _decoded(entries: List[Tuple[StreamId, Fields]]) -> List[dict]:
+        return [
+            {"id": _format_id(stream_id), "data": {k.decode(): v.decode("utf-8", "replace") for k, v in fields.items()}}
+            for stream_id, fields in entries
+        ]
+
+    @staticmethod
+    def _lazy(entries: List[Tuple[StreamId, Fields]]) -> List[dict]:
+        return [{"id": _format_id(stream_id), "message": LazyMessage(fields)} for stream_id, fields in entries]
+
+    def enqueue(self, queue_name: str, item: Any) -> int:
+        with self.store.lock:
+            return self._enqueue(queue_name, item)
+
+    def dequeue(self, queue_name: str, block: bool = True, timeout: int = 0) -> Optional[Any]:
+        return self.store.wait(lambda: self._pop(queue_name), _blocking_timeout(block, timeout))
+
+    def enqueue_stream(self, stream_name: str, item: any, maxlen: int = 1000) -> str:
+        with self.store.lock:
+            return self._append(stream_name, [{"data": str(item)}], maxlen, None)[0][0]
+
+    def enqueue_stream_atomic(self, stream_name: str, item: Any, maxlen: int = 1000,
+                              ttl: int = STREAM_TTL) -> Tuple[str, int]:
+        with self.store.lock:
+            ids, length = self._append(stream_name, [self.codec.encode(item)], maxlen, ttl)
+        return ids[0], length
+
+    def enqueue_stream_many(self, stream_name: str, items: Iterable[Any], maxlen: int = 1000,
+                            ttl: int = STREAM_TTL) -> List[str]:
+        fields_list = [self.codec.encode(item) for item in items]
+        if not fields_list:
+            return []
+        with self.store.lock:
+            return self._append(stream_name, fields_list, maxlen, ttl)[0]
+
+    def stream_peek_latest(self, stream_name: str, block: bool = True, timeout: int = 0) -> Optional[dict]:
+        with self.store.lock:
+            stream = self.store.stream(stream_name)
+            cursor = _format_id(stream.last_id) if stream else "0"
+        entries = self.store.wait(lambda: self._read(stream_name, cursor, 1), _blocking_timeout(block, timeout))
+        return self._decoded(entries)[0] if entries else None
+
+    def stream_read(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                    block: bool = True, timeout: int = 0) -> List[dict]:
+        entries = self.store.wait(lambda: self._read(stream_name, last_id, count), _blocking_timeout(block, timeout))
+        return self._decoded(entries)
+
+    def stream_read_messages(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                             block: bool = True, timeout: int = 0) -> List[dict]:
+        entries = self.store.wait(lambda: self._read(stream_name, last_id, count), _blocking_timeout(block, timeout))
+        return self._lazy(entries)
+
+    def qsize(self, queue_name: str) -> int:
+        with self.store.lock:
+            return self._size(queue_name)
+
+    def clear(self, queue_name: str) -> int:
+        with self.store.lock:
+            return self._clear(queue_name)
+
+    def queue_exists(self, queue_name: str) -> bool:
+        with self.store.lock:
+            return any(queue_name in registry for registry in self.store.registry.values())
+
+    def get_all_queues(self, prefix: str = "session:", key_type: str = "list") -> list:
+        with self.store.lock:
+            return self._registered(prefix, key_type)
+
+    def scan_queues(self, prefix: str = "session:", key_type: str = "list") -> list:
+        with self.store.lock:
+            keys = list(self.store.lists) + list(self.store.streams)
+            return [key for key in keys if key.startswith(prefix) and self.store.key_type(key) == key_type]
+
+    def rebuild_registry(self, prefix: str = "") -> int:
+        """进程内队列在写入时登记，索引总是完整的，这里只为接口一致"""
+        return 0
+
+    def hset(self, name: str, mapping: Dict[str, Any], ttl: Optional[int] = None) -> int:
+        with self.store.lock:
+            return self._hset(name, mapping, ttl)
+
+    def hgetall(self, name: str) -> Dict[str, str]:
+        with self.store.lock:
+            return self._hgetall(name)
+
+    def expire(self, name: str, ttl: int) -> bool:
+        with self.store.lock:
+            if self.store.key_type(name) == "none":
+                return False
+            self.store.set_ttl(name, ttl)
+            return True
+
+
+class AsyncMemoryQueue(MemoryQueue):
+    """与AsyncRedisQueue接口相同的进程内队列，阻塞读取在事件循环上等待"""
+
+    async def ping(self):
+        return None
+
+    async def close(self):
+        return None
+
+    async def enqueue(self, queue_name: str, item: Any) -> int:
+        return super().enqueue(queue_name, item)
+
+    async def dequeue(self, queue_name: str, block: bool = True, timeout: int = 0) -> Optional[Any]:
+        return await self.store.wait_async(lambda: self._pop(queue_name), _blocking_timeout(block, timeout))
+
+    async def enqueue_stream(self, stream_name: str, item: any, maxlen: int = 1000) -> str:
+        return super().enqueue_stream(stream_name, item, maxlen)
+
+    async def enqueue_stream_atomic(self, stream_name: str, item: Any, maxlen: int = 1000,
+                                    ttl: int = STREAM_TTL) -> Tuple[str, int]:
+        return super().enqueue_stream_atomic(stream_name, item, maxlen, ttl)
+
+    async def enqueue_stream_many(self, stream_name: str, items: Iterable[Any], maxlen: int = 1000,
+                                  ttl: int = STREAM_TTL) -> List[str]:
+        return super().enqueue_stream_many(stream_name, items, maxlen, ttl)
+
+    async def enqueue_streams(self, batches: Dict[str, List[Any]], maxlen: int = 1000, ttl: int = STREAM_TTL,
+                              notify: Optional[Dict[str, List[str]]] = None) -> Dict[str, List[str]]:
+        # 进程内队列只在单个进程中使用，写入即唤醒读取方，不需要收件箱通知
+        encoded = {name: [self.codec.encode(item) for item in items] for name, items in batches.items() if items}
+        with self.store.lock:
+            return {name: self._append(name, fields_list, maxlen, ttl)[0] for name, fields_list in encoded.items()}
+
+    async def stream_peek_latest(self, stream_name: str, block: bool = True, timeout: int = 0) -> Optional[dict]:
+        with self.store.lock:
+            stream = self.store.stream(stream_name)
+            cursor = _format_id(stream.last_id) if stream else "0"
+        entries = await self.store.wait_async(
+            lambda: self._read(stream_name, cursor, 1), _blocking_timeout(block, timeout)
+        )
+        return self._decoded(entries)[0] if entries else None
+
+    async def stream_read(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                          block: bool = True, timeout: int = 0) -> List[dict]:
+        entries = await self.store.wait_async(
+            lambda: self._read(stream_name, last_id, count), _blocking_timeout(block, timeout)
+        )
+        return self._decoded(entries)
+
+    async def stream_read_messages(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                                   block: bool = True, timeout: int = 0) -> List[dict]:
+        entries = await self.store.wait_async(
+            lambda: self._read(stream_name, last_id, count), _blocking_timeout(block, timeout)
+        )
+        return self._lazy(entries)
+
+    async def stream_read_many(self, cursors: Dict[str, str], count: int = STREAM_READ_COUNT,
+                               block: bool = True, timeout: float = 0) -> Dict[str, List[dict]]:
+        if not cursors:
+            return {}
+
+        def check() -> Dict[str, List[Tuple[StreamId, Fields]]]:
+            results = {name: self._read(name, cursor, count) for name, cursor in cursors.items()}
+            return {name: entries for name, entries in results.items() if entries}
+
+        results = await self.store.wait_async(check, _blocking_timeout(block, timeout))
+        return {name: self._lazy(entries) for name, entries in results.items()}
+
+    async def stream_cursor_now(self) -> str:
+        now = time.time()
+        return stream_cursor_from_time(int(now), int(now % 1 * 1_000_000))
+
+    async def qsize(self, queue_name: str) -> int:
+        return super().qsize(queue_name)
+
+    async def clear(self, queue_name: str) -> int:
+        return super().clear(queue_name)
+
+    async def queue_exists(self, queue_name: str) -> bool:
+        return super().queue_exists(queue_name)
+
+    async def get_all_queues(self, prefix: str = "session:", key_type: str = "list") -> list:
+        return super().get_all_queues(prefix, key_type)
+
+    async def hset(self, name: str, mapping: Dict[str, Any], ttl: Optional[int] = None) -> int:
+        return super().hset(name, mapping, ttl)
+
+    async def hgetall(self, name: str) -> Dict[str, str]:
+        return super().hgetall(name)
+
+    async def expire(self, name: str, ttl: int) -> bool:
+        return super().expire(name, ttl)
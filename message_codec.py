@@ -0,0 +1,143 @@
+"""
+消息流的消息编码
+功能：把消息编码为带类型字段（发送者、时间、消息ID）和紧凑消息体的Redis Stream条目，
+消息体可选JSON或msgpack，较大的消息体（如聊天记录）再用zlib压缩；读取时按需解码消息体
+"""
+import json
+import os
+import time
+import zlib
+from typing import Any, Dict, Optional, Union
+
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+try:
+    import msgpack
+except ImportError:  # msgpack是可选依赖
+    msgpack = None
+
+# 消息体编码格式：json 或 msgpack
+MESSAGE_CODEC = os.getenv('MESSAGE_CODEC', 'json').lower()
+# 编码后的消息体超过该字节数时用zlib压缩，0表示不压缩
+MESSAGE_COMPRESS_MIN_BYTES = int(os.getenv('MESSAGE_COMPRESS_MIN_BYTES', 1024))
+
+# 消息体第一个字节标记编码方式，大写表示经过zlib压缩；解码时按标记处理，与当前配置无关
+_JSON, _MSGPACK = b"j", b"m"
+_COMPRESSED = {_JSON: b"J", _MSGPACK: b"M"}
+_DECOMPRESSED = {v: k for k, v in _COMPRESSED.items()}
+
+# Stream条目中的字段名
+FIELD_BODY = "body"
+FIELD_SENDER = "sender"
+FIELD_MESSAGE_ID = "message_id"
+FIELD_TIMESTAMP = "ts"
+# 旧格式（RedisQueue.enqueue_stream）只有一个data字段，内容为str(item)
+FIELD_LEGACY = "data"
+
+
+class StreamMessage:
+    """写入消息流的一条消息"""
+    def __init__(
+        self,
+        body: Any,
+        sender: str = "",
+        message_id: str = "",
+        timestamp: Optional[float] = None,
+    ):
+        self.body = body
+        self.sender = sender
+        self.message_id = message_id
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+
+class MessageCodec:
+    """消息体编解码器"""
+    def __init__(self, codec: str = MESSAGE_CODEC, compress_min_bytes: int = MESSAGE_COMPRESS_MIN_BYTES):
+        if codec == "msgpack" and msgpack is None:
+            logger.warning("未安装msgpack，消息体改用JSON编码")
+            codec = "json"
+        if codec not in ("json", "msgpack"):
+            raise ValueError(f"不支持的消息编码: {codec}")
+        self.codec = codec
+        self.compress_min_bytes = compress_min_bytes
+
+    def encode_body(self, body: Any) -> bytes:
+        if self.codec == "msgpack":
+            marker, data = _MSGPACK, msgpack.packb(body, use_bin_type=True)
+        else:
+            marker, data = _JSON, json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if self.compress_min_bytes and len(data) >= self.compress_min_bytes:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                return _COMPRESSED[marker] + compressed
+        return marker + data
+
+    @staticmethod
+    def decode_body(raw: bytes) -> Any:
+        marker, data = raw[:1], raw[1:]
+        if marker in _DECOMPRESSED:
+            marker, data = _DECOMPRESSED[marker], zlib.decompress(data)
+        if marker == _JSON:
+            return json.loads(data)
+        if marker == _MSGPACK:
+            if msgpack is None:
+                raise ValueError("消息使用msgpack编码，但未安装msgpack")
+            return msgpack.unpackb(data, raw=False)
+        raise ValueError(f"未知的消息编码标记: {marker!r}")
+
+    def encode(self, message: Union[StreamMessage, Any]) -> Dict[str, Union[str, bytes]]:
+        """编码为Stream条目的字段；非StreamMessage的对象作为消息体"""
+        if not isinstance(message, StreamMessage):
+            message = StreamMessage(message)
+        return {
+            FIELD_SENDER: message.sender,
+            FIELD_MESSAGE_ID: message.message_id,
+            FIELD_TIMESTAMP: repr(message.timestamp),
+            FIELD_BODY: self.encode_body(message.body),
+        }
+
+
+class LazyMessage:
+    """
+    从消息流读出的一条消息。
+
+    发送者、消息ID和时间直接可用，消息体在第一次访问body时才解码，
+    只需要按发送者或消息ID路由/去重的读者不必付出解码成本。兼容旧格式的data字段。
+    """
+    def __init__(self, fields: Dict[bytes, bytes]):
+        self._fields = fields
+        self._body: Any = None
+        self._decoded = False
+
+    def _text(self, name: str) -> str:
+        value = self._fields.get(name.encode())
+        return value.decode("utf-8") if value is not None else ""
+
+    @property
+    def sender(self) -> str:
+        return self._text(FIELD_SENDER)
+
+    @property
+    def message_id(self) -> str:
+        return self._text(FIELD_MESSAGE_ID)
+
+    @property
+    def timestamp(self) -> Optional[float]:
+        value = self._text(FIELD_TIMESTAMP)
+        return float(value) if value else None
+
+    @property
+    def body(self) -> Any:
+        if not self._decoded:
+            raw = self._fields.get(FIELD_BODY.encode())
+            if raw is not None:
+                self._body = MessageCodec.decode_body(raw)
+            else:
+                self._body = self._text(FIELD_LEGACY)
+            self._decoded = True
+        return self._body
+
+
+# 进程级默认编解码器
+default_codec = MessageCodec()
@@ -1,39 +1,110 @@
 ﻿import os
 import redis
+import redis.asyncio
 import time
 
-from typing import Optional, Any
+from typing import Optional, Any, Dict, Iterable, List, Tuple
+from redis_pool import get_connection_pool, get_async_connection_pool
+from message_codec import LazyMessage, MessageCodec, default_codec
 # Initialize logger for RedisQueue
 from logger_config import setup_logger
 logger = setup_logger(__name__)
 
 
+def _default_db() -> int:
+    """Resolve the Redis DB index for the current IT_ENVIRONMENT"""
+    # Get environment and set appropriate Redis DB index
+    environment = os.getenv("IT_ENVIRONMENT", "dev")
+    if environment == "dev":
+        return int(os.getenv("REDIS_DB_INDEX_DEV", 0))
+    elif environment == "test":
+        return int(os.getenv("REDIS_DB_INDEX_TEST", 1))
+    logger.warning(f"Unknown environment {environment}, defaulting to development database (index 0)")
+    return 0  # Default to dev DB if environment not specified
+
+
+# Default number of entries drained per XREAD round trip
+STREAM_READ_COUNT = int(os.getenv("REDIS_STREAM_READ_COUNT", 100))
+# Sorted sets indexing active queues by type (member = queue name, score = last write time)
+QUEUE_REGISTRY_KEY = os.getenv("REDIS_QUEUE_REGISTRY_KEY", "redis_queue:registry")
+QUEUE_TYPES = ("list", "stream")
+# Keys fetched per SCAN iteration when discovering queues without the registry
+SCAN_COUNT = 500
+# Idle streams expire after this many seconds; every enqueue refreshes the TTL
+STREAM_TTL = int(os.getenv("REDIS_STREAM_TTL", 86400))
+
+
+def registry_key(key_type: str) -> str:
+    """Registry sorted set holding queues of the given type"""
+    return f"{QUEUE_REGISTRY_KEY}:{key_type}"
+
+
+def _first_stream_entry(response) -> Optional[dict]:
+    """Convert an XREAD response holding at most one entry into {'id', 'data'}"""
+    if not response:
+        return None
+    _, messages = response[0]
+    message_id, message_data = messages[0]
+    return {"id": message_id, "data": message_data}
+
+
+def _stream_entries(response) -> List[dict]:
+    """Convert a single-stream XREAD response into a list of {'id', 'data'}"""
+    if not response:
+        return []
+    _, messages = response[0]
+    return [{"id": message_id, "data": message_data} for message_id, message_data in messages]
+
+
+def _lazy_entries(messages) -> List[dict]:
+    """Convert raw (bytes) XREAD messages into {'id', 'message'} with lazily decoded bodies"""
+    return [
+        {"id": message_id.decode(), "message": LazyMessage(fields)}
+        for message_id, fields in messages
+    ]
+
+
+def _queue_stream_append(pipe, codec: MessageCodec, stream_name: str, items: List[Any],
+                         maxlen: int, ttl: int):
+    """Queue one XADD per item plus TTL refresh and registry update on a MULTI/EXEC pipeline"""
+    for item in items:
+        pipe.xadd(stream_name, fields=codec.encode(item), maxlen=maxlen, approximate=True)
+    pipe.expire(stream_name, ttl)
+    pipe.zadd(registry_key("stream"), {stream_name: time.time()})
+
+
+def stream_cursor_from_time(seconds: int, microseconds: int) -> str:
+    """
+    Cursor for reading stream entries added at or after the given Redis
+    server time (as returned by TIME): the largest ID of the previous millisecond.
+    """
+    milliseconds = seconds * 1000 + microseconds // 1000
+    return f"{milliseconds - 1}-{2 ** 64 - 1}"
+
+
 class RedisQueue:
-    def __init__(self, host: str = None, port: int = None, db: int = None, password: str = None):
+    def __init__(self, host: str = None, port: int = None, db: int = None, password: str = None,
+                 codec: Optional[MessageCodec] = None):
         self.host = host or os.getenv("REDIS_HOST", "localhost")
         self.port = port or int(os.getenv("REDIS_PORT", 6379))
-        # Get environment and set appropriate Redis DB index
-        environment = os.getenv("IT_ENVIRONMENT", "dev")
-        if environment == "dev":
-            self.db = int(os.getenv("REDIS_DB_INDEX_DEV", 0))
-        elif environment == "test":
-            self.db = int(os.getenv("REDIS_DB_INDEX_TEST", 1))
-        else:
-            self.db = 0  # Default to dev DB if environment not specified
-            logger.warning(f"Unknown environment {environment}, defaulting to development database (index 0)")
-        self.password = password or os.getenv("REDIS_PASSWORD")
         # Load database index from environment configuration
-        self.client = redis.Redis(
-            host=self.host,
-            port=self.port,
-            db=self.db,
-            password=self.password,
-            decode_responses=True
+        self.db = db if db is not None else _default_db()
+        self.password = password or os.getenv("REDIS_PASSWORD")
+        # All RedisQueue instances in the process share one pool per server/DB
+        self.pool = get_connection_pool(self.host, self.port, self.db, self.password)
+        self.client = redis.Redis(connection_pool=self.pool)
+        # Stream messages carry binary bodies, so they are read through a non-decoding pool
+        self.raw_client = redis.Redis(
+            connection_pool=get_connection_pool(self.host, self.port, self.db, self.password, decode_responses=False)
         )
-        try:
-            self.client.ping()
-        except redis.ConnectionError:
-            raise Exception("Could not connect to Redis server. Please ensure Redis is running.")
+        self.codec = codec or default_codec
+        # Only the first queue on a pool verifies the connection
+        if not self.pool.stats.verified:
+            try:
+                self.client.ping()
+            except redis.ConnectionError:
+                raise Exception("Could not connect to Redis server. Please ensure Redis is running.")
+            self.pool.stats.verified = True
     # async def __aenter__(self):
     #     self.client = await aioredis.from_url(self.connection_string)
     #     return self
@@ -43,7 +114,10 @@ class RedisQueue:
         
     def enqueue(self, queue_name: str, item: Any) -> int:
         """Add an item to the end of the queue"""
-        return self.client.rpush(queue_name, item)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.rpush(queue_name, item)
+        pipe.zadd(registry_key("list"), {queue_name: time.time()})
+        return pipe.execute()[0]
 
     def dequeue(self, queue_name: str, block: bool = True, timeout: int = 0) -> Optional[Any]:
         """Remove and return an item from the front of the queue"""
@@ -54,8 +128,9 @@ class RedisQueue:
             return item[1] if item else None
         else:
             # Non-blocking mode: returns immediately
+            item = self.client.lpop(queue_name)
             logger.debug(f"Non-blocking dequeue from {queue_name}: {item}")
-            return self.client.lpop(queue_name)
+            return item
 
     def enqueue_stream(self, stream_name: str, item: any, maxlen: int = 1000) -> str:
         """
@@ -70,16 +145,65 @@ class RedisQueue:
             The ID of the added message.
         """
         try:
-            return self.client.xadd(
+            pipe = self.client.pipeline(transaction=False)
+            pipe.xadd(
                 stream_name,
                 fields={"data": str(item)},
                 maxlen=maxlen,
                 approximate=True
             )
+            pipe.zadd(registry_key("stream"), {stream_name: time.time()})
+            return pipe.execute()[0]
         except redis.RedisError as e:
             logger.error(f"Failed to enqueue to stream '{stream_name}': {e}")
             return ""
 
+    def enqueue_stream_atomic(self, stream_name: str, item: Any, maxlen: int = 1000,
+                              ttl: int = STREAM_TTL) -> Tuple[str, int]:
+        """
+        Append to a stream in a single MULTI/EXEC round trip: XADD with
+        approximate trimming, refresh the stream TTL, update the queue
+        registry and read the new length.
+
+        Args:
+            stream_name: Name of the stream (queue name).
+            item: A message_codec.StreamMessage, or a plain body encoded with self.codec.
+            maxlen: Maximum number of messages to retain in the stream.
+            ttl: Seconds until the stream expires unless written to again.
+
+        Returns:
+            (message ID, stream length after the append). A length of 1 means the stream was just created.
+
+        Raises:
+            redis.RedisError: Unlike enqueue_stream, errors are not swallowed.
+        """
+        pipe = self.client.pipeline(transaction=True)
+        _queue_stream_append(pipe, self.codec, stream_name, [item], maxlen, ttl)
+        pipe.xlen(stream_name)
+        message_id, _, _, length = pipe.execute()
+        return message_id, length
+
+    def enqueue_stream_many(self, stream_name: str, items: Iterable[Any], maxlen: int = 1000,
+                            ttl: int = STREAM_TTL) -> List[str]:
+        """
+        Append several messages to a stream in a single MULTI/EXEC round trip.
+
+        Messages are encoded with self.codec (see enqueue_stream_atomic); the
+        TTL and queue registry are refreshed once for the whole batch.
+
+        Returns:
+            The IDs of the added messages, in order.
+
+        Raises:
+            redis.RedisError: Errors are not swallowed.
+        """
+        items = list(items)
+        if not items:
+            return []
+        pipe = self.client.pipeline(transaction=True)
+        _queue_stream_append(pipe, self.codec, stream_name, items, maxlen, ttl)
+        return pipe.execute()[:len(items)]
+
     def stream_peek_latest(self, stream_name: str, block: bool = True, timeout: int = 0) -> Optional[dict]:
         """
         Blocking or non-blocking peek of the latest item from a Redis Stream without deleting it.
@@ -99,17 +223,53 @@ class RedisQueue:
             block_ms = int(timeout * 1000) if block else 0
 
             response = self.client.xread({stream_name: last_id}, count=1, block=block_ms)
-
-            if not response:
-                return None
-
-            _, messages = response[0]
-            message_id, message_data = messages[0]
-            return {"id": message_id, "data": message_data}
+            return _first_stream_entry(response)
         except redis.RedisError as e:
             logger.error(f"Failed to peek latest from stream '{stream_name}': {e}")
             return None
 
+    def stream_read(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                    block: bool = True, timeout: int = 0) -> List[dict]:
+        """
+        Read up to `count` entries added after `last_id` without deleting them.
+
+        Unlike stream_peek_latest, nothing added between two calls is missed as
+        long as the caller passes the ID of the last entry it delivered.
+
+        Args:
+            stream_name: Name of the Redis stream.
+            last_id: Cursor; only entries with a greater ID are returned.
+            count: Maximum number of entries returned per call.
+            block: Whether to block until a new item is available.
+            timeout: Maximum blocking time in seconds (only if block=True).
+
+        Returns:
+            A list of dicts with 'id' and 'data' keys, oldest first (empty on timeout).
+        """
+        try:
+            block_ms = int(timeout * 1000) if block else None
+            return _stream_entries(self.client.xread({stream_name: last_id}, count=count, block=block_ms))
+        except redis.RedisError as e:
+            logger.error(f"Failed to read from stream '{stream_name}': {e}")
+            return []
+
+    def stream_read_messages(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                             block: bool = True, timeout: int = 0) -> List[dict]:
+        """
+        Like stream_read, but for messages written through the codec
+        (enqueue_stream_atomic / enqueue_stream_many).
+
+        Returns:
+            A list of dicts with 'id' and 'message' (a message_codec.LazyMessage) keys, oldest first.
+        """
+        try:
+            block_ms = int(timeout * 1000) if block else None
+            response = self.raw_client.xread({stream_name: last_id}, count=count, block=block_ms)
+            return _lazy_entries(response[0][1]) if response else []
+        except redis.RedisError as e:
+            logger.error(f"Failed to read from stream '{stream_name}': {e}")
+            return []
+
     def qsize(self, queue_name: str) -> int:
         """
         Return the size of the queue, supporting both List and Stream types"
@@ -130,16 +290,304 @@ class RedisQueue:
             return 0
 
     def clear(self, queue_name: str) -> int:
-        """Clear all items from the queue"""
-        return self.client.delete(queue_name)
-
-    def get_all_queues(self, prefix: str = "session:") -> list:
-        """Get all queue names with the given prefix that are lists"""
-        keys = self.client.keys(f"{prefix}*")
-        list_keys = []
-        for key in keys:
-            # 只返回列表类型的键
-            if self.client.type(key) == 'list':
-                list_keys.append(key)
-        return list_keys
+        """Clear all items from the queue and drop it from the registry"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(queue_name)
+        for key_type in QUEUE_TYPES:
+            pipe.zrem(registry_key(key_type), queue_name)
+        return pipe.execute()[0]
+
+    def queue_exists(self, queue_name: str) -> bool:
+        """Whether the queue is registered (written to and not cleared), in one round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for key_type in QUEUE_TYPES:
+            pipe.zscore(registry_key(key_type), queue_name)
+        return any(score is not None for score in pipe.execute())
+
+    def get_all_queues(self, prefix: str = "session:", key_type: str = "list") -> list:
+        """Get all registered queue names of the given type with the given prefix"""
+        return [name for name in self.client.zrange(registry_key(key_type), 0, -1) if name.startswith(prefix)]
+
+    def scan_queues(self, prefix: str = "session:", key_type: str = "list") -> list:
+        """
+        Discover queues with SCAN instead of the registry (e.g. keys written
+        before the registry existed). TYPE checks are pipelined per SCAN batch,
+        and unlike KEYS the server is never blocked for the whole keyspace.
+        """
+        queues = []
+        cursor = 0
+        while True:
+            cursor, keys = self.client.scan(cursor, match=f"{prefix}*", count=SCAN_COUNT)
+            if keys:
+                pipe = self.client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.type(key)
+                queues.extend(key for key, found in zip(keys, pipe.execute()) if found == key_type)
+            if cursor == 0:
+                return queues
+
+    def rebuild_registry(self, prefix: str = "") -> int:
+        """Register every existing list/stream queue with the prefix; returns the number registered"""
+        registered = 0
+        now = time.time()
+        for key_type in QUEUE_TYPES:
+            queues = self.scan_queues(prefix, key_type)
+            if queues:
+                self.client.zadd(registry_key(key_type), {name: now for name in queues})
+                registered += len(queues)
+        logger.info(f"Queue registry rebuilt: {registered} queues with prefix '{prefix}'")
+        return registered
+
+    def hset(self, name: str, mapping: Dict[str, Any], ttl: Optional[int] = None) -> int:
+        """Set hash fields, optionally refreshing the key's TTL in the same round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(name, mapping=mapping)
+        if ttl:
+            pipe.expire(name, ttl)
+        return pipe.execute()[0]
+
+    def hgetall(self, name: str) -> Dict[str, str]:
+        """Return all fields of a hash"""
+        return self.client.hgetall(name)
+
+    def expire(self, name: str, ttl: int) -> bool:
+        """Set a key's TTL in seconds; False if the key does not exist"""
+        return self.client.expire(name, ttl)
+
+
+class AsyncRedisQueue:
+    """
+    asyncio counterpart of RedisQueue built on redis.asyncio.
+
+    Exposes the same methods as coroutines, so blocking reads (BLPOP/XREAD)
+    wait on the event loop instead of occupying a default-executor thread.
+    Connection settings are resolved exactly like RedisQueue. Since the
+    constructor cannot await, call ping() once at startup to verify the
+    server is reachable.
+    """
+    def __init__(self, host: str = None, port: int = None, db: int = None, password: str = None,
+                 codec: Optional[MessageCodec] = None):
+        self.host = host or os.getenv("REDIS_HOST", "localhost")
+        self.port = port or int(os.getenv("REDIS_PORT", 6379))
+        self.db = db if db is not None else _default_db()
+        self.password = password or os.getenv("REDIS_PASSWORD")
+        self.pool = get_async_connection_pool(self.host, self.port, self.db, self.password)
+        self.client = redis.asyncio.Redis(connection_pool=self.pool)
+        self.raw_client = redis.asyncio.Redis(
+            connection_pool=get_async_connection_pool(
+                self.host, self.port, self.db, self.password, decode_responses=False
+            )
+        )
+        self.codec = codec or default_codec
+
+    async def ping(self):
+        """Verify the connection once per pool, raising the same error as RedisQueue.__init__"""
+        if self.pool.stats.verified:
+            return
+        try:
+            await self.client.ping()
+        except redis.ConnectionError:
+            raise Exception("Could not connect to Redis server. Please ensure Redis is running.")
+        self.pool.stats.verified = True
+
+    async def close(self):
+        """Release the client; the shared pool is closed by redis_pool.close_async_pools()"""
+        await self.client.aclose(close_connection_pool=False)
+        await self.raw_client.aclose(close_connection_pool=False)
+
+    async def enqueue(self, queue_name: str, item: Any) -> int:
+        """Add an item to the end of the queue"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.rpush(queue_name, item)
+        pipe.zadd(registry_key("list"), {queue_name: time.time()})
+        return (await pipe.execute())[0]
+
+    async def dequeue(self, queue_name: str, block: bool = True, timeout: int = 0) -> Optional[Any]:
+        """Remove and return an item from the front of the queue"""
+        if block:
+            item = await self.client.blpop(queue_name, timeout=timeout)
+            logger.debug(f"Blocking dequeue from {queue_name}: {item}")
+            return item[1] if item else None
+        item = await self.client.lpop(queue_name)
+        logger.debug(f"Non-blocking dequeue from {queue_name}: {item}")
+        return item
+
+    async def enqueue_stream(self, stream_name: str, item: any, maxlen: int = 1000) -> str:
+        """Add an item to a Redis Stream, trimming it to roughly maxlen entries"""
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.xadd(
+                stream_name,
+                fields={"data": str(item)},
+                maxlen=maxlen,
+                approximate=True
+            )
+            pipe.zadd(registry_key("stream"), {stream_name: time.time()})
+            return (await pipe.execute())[0]
+        except redis.RedisError as e:
+            logger.error(f"Failed to enqueue to stream '{stream_name}': {e}")
+            return ""
+
+    async def enqueue_stream_atomic(self, stream_name: str, item: Any, maxlen: int = 1000,
+                                    ttl: int = STREAM_TTL) -> Tuple[str, int]:
+        """Same as RedisQueue.enqueue_stream_atomic: one MULTI/EXEC round trip returning (ID, length)"""
+        pipe = self.client.pipeline(transaction=True)
+        _queue_stream_append(pipe, self.codec, stream_name, [item], maxlen, ttl)
+        pipe.xlen(stream_name)
+        message_id, _, _, length = await pipe.execute()
+        return message_id, length
+
+    async def enqueue_stream_many(self, stream_name: str, items: Iterable[Any], maxlen: int = 1000,
+                                  ttl: int = STREAM_TTL) -> List[str]:
+        """Same as RedisQueue.enqueue_stream_many: one MULTI/EXEC round trip returning the new IDs"""
+        items = list(items)
+        if not items:
+            return []
+        pipe = self.client.pipeline(transaction=True)
+        _queue_stream_append(pipe, self.codec, stream_name, items, maxlen, ttl)
+        return (await pipe.execute())[:len(items)]
+
+    async def enqueue_streams(self, batches: Dict[str, List[Any]], maxlen: int = 1000,
+                              ttl: int = STREAM_TTL,
+                              notify: Optional[Dict[str, List[str]]] = None) -> Dict[str, List[str]]:
+        """
+        Append messages to several streams in a single MULTI/EXEC round trip.
+
+        Args:
+            batches: Mapping of stream name -> messages, appended in order.
+            notify: Mapping of inbox stream -> stream names; after the messages, one
+                notification per stream name (its body) is appended to each inbox in
+                the same transaction, so a reader woken by it always finds the messages.
+
+        Returns:
+            Mapping of stream name -> IDs of the added messages.
+        """
+        batches = {name: items for name, items in batches.items() if items}
+        if not batches:
+            return {}
+        pipe = self.client.pipeline(transaction=True)
+        for stream_name, items in batches.items():
+            _queue_stream_append(pipe, self.codec, stream_name, items, maxlen, ttl)
+        for inbox, stream_names in (notify or {}).items():
+            for stream_name in stream_names:
+                pipe.xadd(inbox, fields=self.codec.encode(stream_name), maxlen=maxlen, approximate=True)
+            pipe.expire(inbox, ttl)
+        results = await pipe.execute()
+        ids = {}
+        offset = 0
+        for stream_name, items in batches.items():
+            ids[stream_name] = results[offset:offset + len(items)]
+            # Skip the EXPIRE and ZADD replies queued after each stream's XADDs
+            offset += len(items) + 2
+        return ids
+
+    async def stream_peek_latest(self, stream_name: str, block: bool = True, timeout: int = 0) -> Optional[dict]:
+        """
+        Wait for the next item added to a Redis Stream without deleting it.
+        Same semantics as RedisQueue.stream_peek_latest.
+        """
+        try:
+            block_ms = int(timeout * 1000) if block else None
+            response = await self.client.xread({stream_name: "$"}, count=1, block=block_ms)
+            return _first_stream_entry(response)
+        except redis.RedisError as e:
+            logger.error(f"Failed to peek latest from stream '{stream_name}': {e}")
+            return None
+
+    async def stream_read(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                          block: bool = True, timeout: int = 0) -> List[dict]:
+        """
+        Read up to `count` entries added after `last_id` without deleting them.
+        Same semantics as RedisQueue.stream_read.
+        """
+        try:
+            block_ms = int(timeout * 1000) if block else None
+            return _stream_entries(await self.client.xread({stream_name: last_id}, count=count, block=block_ms))
+        except redis.RedisError as e:
+            logger.error(f"Failed to read from stream '{stream_name}': {e}")
+            return []
+
+    async def stream_read_messages(self, stream_name: str, last_id: str, count: int = STREAM_READ_COUNT,
+                                   block: bool = True, timeout: int = 0) -> List[dict]:
+        """Same as RedisQueue.stream_read_messages: entries with 'id' and a lazily decoded 'message'"""
+        try:
+            block_ms = int(timeout * 1000) if block else None
+            response = await self.raw_client.xread({stream_name: last_id}, count=count, block=block_ms)
+            return _lazy_entries(response[0][1]) if response else []
+        except redis.RedisError as e:
+            logger.error(f"Failed to read from stream '{stream_name}': {e}")
+            return []
+
+    async def stream_read_many(self, cursors: Dict[str, str], count: int = STREAM_READ_COUNT,
+                               block: bool = True, timeout: float = 0) -> Dict[str, List[dict]]:
+        """
+        Read several codec-encoded streams in one XREAD round trip.
+
+        Args:
+            cursors: Mapping of stream name -> last delivered ID.
+            count: Maximum number of entries returned per stream.
+
+        Returns:
+            Mapping of stream name -> entries after its cursor, each a dict with
+            'id' and 'message' (a message_codec.LazyMessage); streams with nothing new are omitted.
+        """
+        if not cursors:
+            return {}
+        block_ms = int(timeout * 1000) if block else None
+        response = await self.raw_client.xread(cursors, count=count, block=block_ms)
+        return {stream_name.decode(): _lazy_entries(messages) for stream_name, messages in response or []}
+
+    async def stream_cursor_now(self) -> str:
+        """Cursor for stream_read that returns every entry added from now on"""
+        seconds, microseconds = await self.client.time()
+        return stream_cursor_from_time(seconds, microseconds)
+
+    async def qsize(self, queue_name: str) -> int:
+        """Return the size of the queue, supporting both List and Stream types"""
+        try:
+            key_type = await self.client.type(queue_name)
+            if key_type == 'list':
+                return await self.client.llen(queue_name)
+            elif key_type == 'stream':
+                return await self.client.xlen(queue_name)
+            else:
+                logger.warning(f"Unsupported queue type: {key_type} for queue {queue_name}")
+                return 0
+        except redis.RedisError as e:
+            logger.error(f"Failed to get queue size for {queue_name}: {e}")
+            return 0
+
+    async def clear(self, queue_name: str) -> int:
+        """Clear all items from the queue and drop it from the registry"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(queue_name)
+        for key_type in QUEUE_TYPES:
+            pipe.zrem(registry_key(key_type), queue_name)
+        return (await pipe.execute())[0]
+
+    async def queue_exists(self, queue_name: str) -> bool:
+        """Whether the queue is registered (written to and not cleared), in one round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for key_type in QUEUE_TYPES:
+            pipe.zscore(registry_key(key_type), queue_name)
+        return any(score is not None for score in await pipe.execute())
+
+    async def get_all_queues(self, prefix: str = "session:", key_type: str = "list") -> list:
+        """Get all registered queue names of the given type with the given prefix"""
+        return [name for name in await self.client.zrange(registry_key(key_type), 0, -1) if name.startswith(prefix)]
+
+    async def hset(self, name: str, mapping: Dict[str, Any], ttl: Optional[int] = None) -> int:
+        """Set hash fields, optionally refreshing the key's TTL in the same round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(name, mapping=mapping)
+        if ttl:
+            pipe.expire(name, ttl)
+        return (await pipe.execute())[0]
+
+    async def hgetall(self, name: str) -> Dict[str, str]:
+        """Return all fields of a hash"""
+        return await self.client.hgetall(name)
 
+    async def expire(self, name: str, ttl: int) -> bool:
+        """Set a key's TTL in seconds; False if the key does not exist"""
+        return await self.client.expire(name, ttl)
@@ -0,0 +1,51 @@
+"""
+进程内运行指标
+功能：记录计数器、瞬时值和耗时分布，通过webhook_server的/metrics接口以JSON形式输出
+"""
+import threading
+from typing import Dict
+
+
+class Metrics:
+    """线程安全的进程内指标注册表"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        # name -> {"count", "sum", "max"}
+        self._summaries: Dict[str, Dict[str, float]] = {}
+
+    def incr(self, name: str, value: float = 1):
+        """累加计数器"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        """设置瞬时值（如队列深度）"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """记录一次观测值（如耗时），汇总为次数、总和与最大值"""
+        with self._lock:
+            summary = self._summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    def snapshot(self) -> dict:
+        """返回当前所有指标的快照"""
+        with self._lock:
+            summaries = {
+                name: {**summary, "avg": summary["sum"] / summary["count"] if summary["count"] else 0.0}
+                for name, summary in self._summaries.items()
+            }
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "summaries": summaries,
+            }
+
+
+# 进程级共享的指标注册表
+metrics = Metrics()
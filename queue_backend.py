@@ -0,0 +1,36 @@
+"""
+消息队列后端选择
+功能：根据QUEUE_BACKEND创建同步/异步消息队列：redis（默认，RedisQueue/AsyncRedisQueue）
+或memory（进程内实现，见memory_queue.py，适合单节点部署和无外部服务的基准测试）
+"""
+import os
+
+from memory_queue import MemoryQueue, AsyncMemoryQueue
+from message_queue import RedisQueue, AsyncRedisQueue
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 消息队列后端：redis 或 memory
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'redis').lower()
+
+
+def _check_backend():
+    if QUEUE_BACKEND not in ("redis", "memory"):
+        raise ValueError(f"不支持的消息队列后端: {QUEUE_BACKEND}")
+
+
+def create_queue():
+    """创建同步消息队列（RedisQueue或MemoryQueue）；Redis后端在创建时检查连接"""
+    _check_backend()
+    if QUEUE_BACKEND == "memory":
+        logger.info("使用进程内消息队列")
+        return MemoryQueue()
+    return RedisQueue()
+
+
+def create_async_queue():
+    """创建异步消息队列（AsyncRedisQueue或AsyncMemoryQueue）"""
+    _check_backend()
+    if QUEUE_BACKEND == "memory":
+        return AsyncMemoryQueue()
+    return AsyncRedisQueue()
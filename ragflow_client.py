@@ -1,18 +1,227 @@
 ﻿import os
-import requests
+import asyncio
+import contextlib
+import time
 import aiohttp
-import json
-from typing import Optional
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
 import chainlit as cl
 
+from ragflow_stream import RAGFlowStreamParser, ReferenceAggregator
+from token_coalescer import TokenCoalescer
+from answer_cache import AnswerCache, normalize_question
+from completion_scheduler import CompletionScheduler, SchedulerBusyError
+from resilience import CircuitBreaker, CircuitOpenError, retry_async
+from request_coalescing import RequestCoalescer, REQUEST_COALESCING_ENABLED, request_coalescer
 from logger_config import setup_logger
 logger = setup_logger(__name__)
 
 CHAT_ASSISTANT_NAME = os.getenv('RAGFLOW_ASSISTANT_NAME', 'AI-assist')
 
+# HTTP连接池配置：整个进程共享一个aiohttp会话，复用keep-alive连接
+HTTP_POOL_LIMIT = int(os.getenv('RAGFLOW_HTTP_POOL_LIMIT', 100))
+# 单个主机的最大连接数，0表示不限制（只受HTTP_POOL_LIMIT约束）
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('RAGFLOW_HTTP_POOL_LIMIT_PER_HOST', 0))
+# 空闲连接保持时间（秒）
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('RAGFLOW_HTTP_KEEPALIVE_TIMEOUT', 30))
+
+# 助手名称 -> chat_id 缓存的有效期（秒）
+CHAT_ID_CACHE_TTL = float(os.getenv('RAGFLOW_CHAT_ID_CACHE_TTL', 600))
+# 缓存过期前多少秒开始后台刷新
+CHAT_ID_REFRESH_AHEAD = float(os.getenv('RAGFLOW_CHAT_ID_REFRESH_AHEAD', 60))
+
+# 每个助手预先创建、等待新对话领取的RAGFlow会话数量，0表示不预热
+SESSION_POOL_SIZE = int(os.getenv('RAGFLOW_SESSION_POOL_SIZE', 4))
+# 预热会话的临时名称，被领取后会重命名为所属用户
+POOLED_SESSION_NAME = "chaint_session:pooled"
+
+# 超时配置（秒）：建立连接、两次读取之间的最长间隔、非流式请求的总时长、等待首个token的最长时间
+CONNECT_TIMEOUT = float(os.getenv('RAGFLOW_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('RAGFLOW_READ_TIMEOUT', 60))
+REQUEST_TIMEOUT = float(os.getenv('RAGFLOW_REQUEST_TIMEOUT', 15))
+FIRST_TOKEN_TIMEOUT = float(os.getenv('RAGFLOW_FIRST_TOKEN_TIMEOUT', 30))
+# 幂等请求（查询助手、重命名会话）的最大尝试次数和重试基础等待时间
+RETRY_ATTEMPTS = int(os.getenv('RAGFLOW_RETRY_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.getenv('RAGFLOW_RETRY_BASE_DELAY', 0.2))
+# 熔断配置：连续失败多少次后熔断，熔断多少秒后放行探测请求
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('RAGFLOW_BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RECOVERY_TIMEOUT = float(os.getenv('RAGFLOW_BREAKER_RECOVERY_TIMEOUT', 30))
+
+# 计为RAGFlow故障的异常：网络错误、超时和5xx响应
+UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# 进程级共享的RAGFlow熔断器
+ragflow_breaker = CircuitBreaker(
+    "ragflow",
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    recovery_timeout=BREAKER_RECOVERY_TIMEOUT,
+    failure_exceptions=UPSTREAM_ERRORS,
+)
+
+_http_session: Optional[aiohttp.ClientSession] = None
+# 持有后台任务的引用，避免任务在完成前被垃圾回收
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """获取进程级共享的aiohttp会话（首次调用时创建连接池）"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        # 流式回答可能持续较长时间，这里不设置总超时，只限制连接和两次读取之间的间隔
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+        )
+        logger.info(
+            f"已创建RAGFlow HTTP连接池: limit={HTTP_POOL_LIMIT}, "
+            f"limit_per_host={HTTP_POOL_LIMIT_PER_HOST}, keepalive={HTTP_KEEPALIVE_TIMEOUT}s"
+        )
+    return _http_session
+
+
+async def close_http_session():
+    """关闭进程级共享的aiohttp会话，应在应用退出时调用"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def _spawn_background(coro: Awaitable) -> asyncio.Task:
+    """启动后台任务，异常只记录日志，不影响调用者"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+
+    def _done(t: asyncio.Task):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.warning(f"RAGFlow后台任务失败: {t.exception()}")
+
+    task.add_done_callback(_done)
+    return task
+
+
+class ChatIdCache:
+    """
+    助手名称 -> chat_id 的进程级缓存。
+
+    - 缓存项在TTL内直接返回，不访问RAGFlow；
+    - 同一助手的并发查询只会发出一次上游请求（single-flight），其余调用者等待同一结果；
+    - 缓存项临近过期时在后台刷新，调用者继续使用旧值，不会因刷新而阻塞。
+    """
+    def __init__(self, ttl: float = CHAT_ID_CACHE_TTL, refresh_ahead: float = CHAT_ID_REFRESH_AHEAD):
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        # key -> (chat_id, 过期时间)
+        self._entries: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        # key -> 正在进行的上游查询
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    async def get(self, key: Tuple[str, str], loader: Callable[[], Awaitable[str]]) -> str:
+        """获取chat_id，缓存未命中或已过期时通过loader查询"""
+        entry = self._entries.get(key)
+        if entry:
+            chat_id, expires_at = entry
+            remaining = expires_at - time.monotonic()
+            if remaining > 0:
+                if remaining <= self.refresh_ahead and key not in self._inflight:
+                    logger.debug(f"chat_id缓存即将过期，后台刷新: {key[1]}")
+                    self._load(key, loader)
+                return chat_id
+        # shield：单个调用者被取消时不影响其他等待同一查询的调用者
+        return await asyncio.shield(self._load(key, loader))
+
+    def invalidate(self, key: Optional[Tuple[str, str]] = None):
+        """清除指定缓存项，key为None时清空全部"""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def _load(self, key: Tuple[str, str], loader: Callable[[], Awaitable[str]]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_loaded(key, t))
+        return task
+
+    async def _fetch(self, key: Tuple[str, str], loader: Callable[[], Awaitable[str]]) -> str:
+        chat_id = await loader()
+        self._entries[key] = (chat_id, time.monotonic() + self.ttl)
+        return chat_id
+
+    def _on_loaded(self, key: Tuple[str, str], task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            # 后台刷新失败时保留旧值，等待下次调用重试
+            logger.warning(f"查询助手'{key[1]}'的chat_id失败: {task.exception()}")
+
+
+# 进程级共享的chat_id缓存
+chat_id_cache = ChatIdCache()
+
+
+class SessionPool:
+    """
+    预先创建的RAGFlow会话池。
+
+    新对话的第一个问题可以直接领取一个现成的会话，省去创建会话的网络往返；
+    每次领取后在后台补充，使池中始终保持size个可用会话。
+    """
+    def __init__(self, size: int = SESSION_POOL_SIZE):
+        self.size = size
+        # (base_url, chat_id) -> 可领取的会话ID
+        self._sessions: Dict[Tuple[str, str], Deque[str]] = {}
+        self._filling: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def claim(self, key: Tuple[str, str]) -> Optional[str]:
+        """领取一个预热会话，池为空时返回None"""
+        sessions = self._sessions.get(key)
+        return sessions.popleft() if sessions else None
+
+    def available(self, key: Tuple[str, str]) -> int:
+        """当前可领取的会话数量"""
+        return len(self._sessions.get(key, ()))
+
+    def refill(self, key: Tuple[str, str], factory: Callable[[], Awaitable[str]]) -> Optional[asyncio.Task]:
+        """在后台把会话池补充到size个，已在补充中时不重复启动"""
+        if self.size <= 0:
+            return None
+        task = self._filling.get(key)
+        if task is None and self.available(key) < self.size:
+            task = _spawn_background(self._fill(key, factory))
+            self._filling[key] = task
+            task.add_done_callback(lambda _: self._filling.pop(key, None))
+        return task
+
+    async def _fill(self, key: Tuple[str, str], factory: Callable[[], Awaitable[str]]):
+        sessions = self._sessions.setdefault(key, deque())
+        while len(sessions) < self.size:
+            sessions.append(await factory())
+        logger.debug(f"RAGFlow会话池已补充至{len(sessions)}个: chat_id={key[1]}")
+
+
+# 进程级共享的预热会话池
+session_pool = SessionPool()
+
+
 class RAGFlowClient:
     """RAGFlow API客户端，处理与后端的交互"""
-    def __init__(self, api_key: str, base_url: str):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        answer_cache: Optional[AnswerCache] = None,
+        scheduler: Optional[CompletionScheduler] = None,
+        coalescer: Optional[RequestCoalescer] = None,
+    ):
         self.api_key = api_key
         self.base_url = base_url
         self.headers = {
@@ -20,12 +229,53 @@ class RAGFlowClient:
             'Content-Type': 'application/json'
         }
         self.chat_id: Optional[str] = None
+        # 当前Chainlit对话绑定的RAGFlow会话，多轮问答复用同一会话以保留上下文
+        self.session_id: Optional[str] = None
+        # 回答缓存，为None时不使用缓存
+        self.answer_cache = answer_cache
+        # 回答请求调度器，为None时不限制并发
+        self.scheduler = scheduler
+        # 相同问题的请求合并器，为None时每个问题都单独请求RAGFlow
+        self.coalescer = coalescer if coalescer is not None else (
+            request_coalescer if REQUEST_COALESCING_ENABLED else None
+        )
+        # 当前对话已完成的问答轮数
+        self.turns = 0
+
+    async def get_chat_id(self, assistant_name: str) -> str:
+        """根据助手名称获取聊天ID（经过进程级缓存）"""
+        self.chat_id = await chat_id_cache.get(
+            (self.base_url, assistant_name), lambda: self._fetch_chat_id(assistant_name)
+        )
+        return self.chat_id
+
+    async def _request_json(self, method: str, url: str, idempotent: bool = False, **kwargs) -> dict:
+        """
+        发送非流式请求并返回JSON响应。
+        请求受熔断器保护并有总超时；幂等请求遇到网络错误或超时时按随机退避重试。
+        """
+        async def call() -> dict:
+            async with ragflow_breaker.guard():
+                async with get_http_session().request(
+                    method, url, headers=self.headers,
+                    timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+                    **kwargs
+                ) as response:
+                    if response.status >= 500:
+                        response.raise_for_status()
+                    return await response.json(content_type=None)
+
+        if not idempotent:
+            return await call()
+        return await retry_async(
+            call, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, retry_on=UPSTREAM_ERRORS
+        )
 
-    def get_chat_id(self, assistant_name: str) -> str:
-        """根据助手名称获取聊天ID"""
-        url = f"{self.base_url}/api/v1/chats?name={assistant_name}"
-        response = requests.get(url, headers=self.headers)
-        response_data = response.json()
+    async def _fetch_chat_id(self, assistant_name: str) -> str:
+        """向RAGFlow查询助手名称对应的聊天ID"""
+        response_data = await self._request_json(
+            'GET', f"{self.base_url}/api/v1/chats", idempotent=True, params={'name': assistant_name}
+        )
 
         if response_data['code'] != 0:
             raise ValueError(f"获取助手ID失败: {response_data['message']}")
@@ -34,118 +284,208 @@ class RAGFlowClient:
 
         return response_data['data'][0]['id']
 
-    def create_chat_session(self) -> str:
-        """创建新的聊天会话"""
+    async def create_chat_session(self, session_name: Optional[str] = None) -> str:
+        """创建新的聊天会话（优先从预热会话池领取），未指定名称时使用当前Chainlit用户命名"""
         if not self.chat_id:
-            self.chat_id = self.get_chat_id(CHAT_ASSISTANT_NAME)
+            self.chat_id = await self.get_chat_id(CHAT_ASSISTANT_NAME)
+
+        if session_name is None:
+            session_name = f"chaint_session:{cl.user_session.get('user').identifier}"
+        pool_key = (self.base_url, self.chat_id)
+        session_id = session_pool.claim(pool_key)
+        if session_id:
+            logger.debug(f"从会话池领取RAGFlow会话: {session_id}")
+            # 重命名不在首个token的关键路径上，放到后台执行
+            _spawn_background(self._rename_session(session_id, session_name))
+        else:
+            session_id = await self._create_session(session_name)
+        self.prefill_session_pool()
+        return session_id
+
+    def prefill_session_pool(self) -> Optional[asyncio.Task]:
+        """在后台把当前助手的预热会话池补满"""
+        return session_pool.refill(
+            (self.base_url, self.chat_id), lambda: self._create_session(POOLED_SESSION_NAME)
+        )
+
+    async def get_session_id(self) -> str:
+        """获取当前Chainlit对话绑定的RAGFlow会话，首次调用时创建"""
+        if not self.session_id:
+            self.session_id = await self.create_chat_session()
+        return self.session_id
 
-        url = f"{self.base_url}/api/v1/chats/{self.chat_id}/sessions"
-        session_name = cl.user_session.get("user").identifier
-        response = requests.post(
-            url, headers=self.headers, json={'name': f"chaint_session:{session_name}"}
+    async def _create_session(self, name: str) -> str:
+        """在RAGFlow中创建会话"""
+        response_data = await self._request_json(
+            'POST', f"{self.base_url}/api/v1/chats/{self.chat_id}/sessions", json={'name': name}
         )
-        response_data = response.json()
 
         if response_data['code'] != 0:
             raise ValueError(f"创建会话失败: {response_data['message']}")
 
         return response_data['data']['id']
 
-    async def stream_chat_completion(self, question: str, msg: cl.Message):
-        """流式获取聊天完成结果并直接发送到Chainlit前端"""
-        session_id = self.create_chat_session()
-        url = f"{self.base_url}/api/v1/chats/{self.chat_id}/completions"
+    async def _rename_session(self, session_id: str, name: str):
+        """重命名RAGFlow会话"""
+        response_data = await self._request_json(
+            'PUT', f"{self.base_url}/api/v1/chats/{self.chat_id}/sessions/{session_id}",
+            idempotent=True, json={'name': name}
+        )
 
+        if response_data['code'] != 0:
+            raise ValueError(f"重命名会话失败: {response_data['message']}")
+
+    async def iter_chat_completion(
+        self, question: str, session_id: str, user_id: str, parser: RAGFlowStreamParser
+    ) -> AsyncIterator[str]:
+        """
+        流式请求RAGFlow回答，逐个产出新增文本。
+        流结束后可通过parser.answer获取完整回答，通过parser.referenced_docs()获取引用文档。
+        超过FIRST_TOKEN_TIMEOUT秒仍未收到首个token时抛出TimeoutError；回答请求不重试。
+        """
+        url = f"{self.base_url}/api/v1/chats/{self.chat_id}/completions"
         payload = {
             "question": question,
             "stream": True,
             "session_id": session_id,
-            "user_id": cl.user_session.get("user").identifier
+            "user_id": user_id
         }
 
-        # 用于跟踪已发送的内容，避免重复
-        sent_content = ""
-        # 存储引用的文档
-        referenced_docs = []
-
-        with requests.post(
-            url, headers=self.headers, json=payload, stream=True
-        ) as response:
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        # 处理SSE格式数据
-                        line = line.decode('utf-8').lstrip('data: ').strip()
-                        if not line:
-                            continue
-                        json_data = json.loads(line)
-
-                        # 检查是否为结束标志
-                        if json_data.get('code') == 0 and json_data.get('data') is True:
+        async with ragflow_breaker.guard():
+            async with asyncio.timeout(FIRST_TOKEN_TIMEOUT) as first_token_timeout:
+                async with get_http_session().post(
+                    url, headers=self.headers, json=payload
+                ) as response:
+                    if response.status >= 500:
+                        response.raise_for_status()
+                    async for chunk in response.content.iter_any():
+                        deltas = parser.feed(chunk)
+                        if deltas:
+                            # 收到首个token后取消首token超时，之后只受READ_TIMEOUT约束
+                            first_token_timeout.reschedule(None)
+                        for delta in deltas:
+                            yield delta
+                        if parser.finished:
                             break
+                    else:
+                        first_token_timeout.reschedule(None)
+                        for delta in parser.close():
+                            yield delta
+
+    async def stream_chat_completion(self, question: str, msg: cl.Message):
+        """流式获取聊天完成结果并直接发送到Chainlit前端"""
+        if not self.chat_id:
+            await self.get_chat_id(CHAT_ASSISTANT_NAME)
+
+        # 只有对话的第一个问题使用缓存：后续问题的回答依赖会话上下文；
+        # RAGFlow熔断期间后续问题也尝试用缓存的回答兜底
+        use_cache = self.answer_cache is not None and self.turns == 0
+        degraded = ragflow_breaker.is_open()
+        cached = None
+        if self.answer_cache is not None and (use_cache or degraded):
+            cached = await asyncio.to_thread(self.answer_cache.get, self.chat_id, question)
+        if degraded and not cached:
+            raise CircuitOpenError("RAGFlow暂时不可用")
+
+        # 合并细碎的增量后再推送，减少websocket帧数
+        async with TokenCoalescer(msg.stream_token) as coalescer:
+            if cached:
+                logger.info(f"回答缓存命中: {question[:50]}")
+                await coalescer.push(cached["answer"])
+                references = ReferenceAggregator.from_docs(cached["referenced_docs"])
+            else:
+                user_id = cl.user_session.get("user").identifier
+                parser = None
+                if self.coalescer is not None and self.turns == 0:
+                    # 对话的第一个问题与上下文无关，相同问题正在生成时共享同一个上游流
+                    parser = await self._coalesced_completion(question, user_id, coalescer)
+                if parser is None:
+                    parser = RAGFlowStreamParser()
+                    # 先取得名额再创建会话，被调度器拒绝的请求不会白白创建RAGFlow会话
+                    async with self._completion_slot(user_id):
+                        session_id = await self.get_session_id()
+                        async for delta in self.iter_chat_completion(question, session_id, user_id, parser):
+                            await coalescer.push(delta)
+                    if use_cache:
+                        self._cache_answer(question, parser)
+                references = parser.references()
+        self.turns += 1
 
-                        if (
-                            isinstance(json_data, dict) and 
-                            json_data.get('code') == 0 and 
-                            isinstance(json_data.get('data'), dict)
-                        ):
-                            answer_chunk = json_data['data'].get('answer', '')
-
-                            # 提取引用文档信息（使用doc_aggs聚合数据避免重复）
-                            if 'reference' in json_data['data']:
-                                reference_data = json_data['data']['reference']
-                                # 优先使用doc_aggs获取聚合的引用文档信息
-                                if 'doc_aggs' in reference_data and isinstance(reference_data['doc_aggs'], list):
-                                    # 遍历聚合文档列表
-                                    for doc_info in reference_data['doc_aggs']:
-                                        doc_id = doc_info.get('doc_id')
-                                        doc_name = doc_info.get('doc_name')
-                                        # 检查文档ID和名称是否存在
-                                        if doc_id and doc_name:
-                                            referenced_docs.append((doc_id, doc_name))
-                                # 兼容处理：如果没有doc_aggs则使用chunks（旧版API兼容）
-                                elif 'chunks' in reference_data:
-                                    seen_document_ids = set()
-                                    for chunk in reference_data['chunks']:
-                                        doc_id = chunk.get('document_id')
-                                        doc_name = chunk.get('document_name')
-                                        if doc_id and doc_name and doc_id not in seen_document_ids:
-                                            referenced_docs.append((doc_id, doc_name))
-                                            seen_document_ids.add(doc_id)
-
-                            if answer_chunk and answer_chunk != sent_content:
-                                # 计算新增内容
-                                new_content = answer_chunk[len(sent_content):]
-                                if new_content:
-                                    await msg.stream_token(new_content)
-                                    sent_content = answer_chunk
-                    except json.JSONDecodeError:
-                        continue
-
-            # 使用Chainlit File元素展示引用文档
-            if referenced_docs:
-                # 调试：打印引用文档列表所有内容
-                # Replace print statements with logger.debug
-                # Original: print("【debug】referenced_docs内容: ", json.dumps(referenced_docs, indent=2, ensure_ascii=False))
-                # logger.debug(f"referenced_docs内容: {json.dumps(referenced_docs, indent=2, ensure_ascii=False)}")
-                logger.debug(f"referenced_docs内容: {referenced_docs}")
-                elements = []
-                for doc_id, doc_name in referenced_docs:
-                    doc_url = f"{self.base_url}/document/{doc_id}?ext={doc_name.split('.')[-1]}&prefix=document"
-                    logger.debug(f"变量doc_url的值为: {doc_url}")
-                    elements.append(cl.File(name=doc_name, url=doc_url))
-                # 打印elements变量的值到终端，方便诊断
-                logger.debug(f"elements变量的值为: {elements}")
-                actions = [
-                cl.Action(
+        await self._send_references(references)
+
+        # 明确标记消息完成状态
+        await msg.update()
+
+    async def _coalesced_completion(
+        self, question: str, user_id: str, coalescer: TokenCoalescer
+    ) -> Optional[RAGFlowStreamParser]:
+        """
+        订阅相同问题的共享上游流。
+
+        上游请求和RAGFlow会话属于发起者：加入已有流的对话本轮不创建RAGFlow会话，
+        下一轮提问时才创建，新会话中没有这一轮问答的上下文（回答缓存命中时同样如此）。
+        发起者被调度器拒绝时（此时还没有任何增量）只有发起者收到SchedulerBusyError，
+        其他订阅者返回None，由调用方按自己的名额单独请求。
+        """
+        key = (self.chat_id, normalize_question(question))
+        async with self.coalescer.subscribe(
+            key, lambda emit: self._shared_completion(question, user_id, emit)
+        ) as subscription:
+            try:
+                async for delta in subscription:
+                    await coalescer.push(delta)
+            except SchedulerBusyError:
+                if subscription.leader:
+                    raise
+                logger.info("请求合并：发起者未获得回答名额，单独请求RAGFlow")
+                return None
+        return subscription.result
+
+    async def _shared_completion(
+        self, question: str, user_id: str, emit: Callable[[str], None]
+    ) -> RAGFlowStreamParser:
+        """供多个订阅者共享的上游请求，回答只缓存一次"""
+        parser = RAGFlowStreamParser()
+        async with self._completion_slot(user_id):
+            session_id = await self.get_session_id()
+            async for delta in self.iter_chat_completion(question, session_id, user_id, parser):
+                emit(delta)
+        if self.answer_cache is not None:
+            self._cache_answer(question, parser)
+        return parser
+
+    def _cache_answer(self, question: str, parser: RAGFlowStreamParser):
+        """在后台写入回答缓存（只缓存完整结束的回答）"""
+        if parser.finished and parser.answer:
+            _spawn_background(asyncio.to_thread(
+                self.answer_cache.set, self.chat_id, question, parser.answer, parser.referenced_docs()
+            ))
+
+    def _completion_slot(self, user_id: str):
+        """向调度器申请回答名额（排队超时会抛出SchedulerBusyError）"""
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.slot(user_id)
+
+    async def _send_references(self, references: ReferenceAggregator):
+        """使用Chainlit File元素展示引用文档"""
+        if not references:
+            return
+        logger.debug(f"referenced_docs内容: {references.docs()}, 超出上限未展示: {references.dropped}")
+        elements = []
+        for doc_id, doc_name in references.docs():
+            doc_url = references.doc_url(self.base_url, doc_id)
+            logger.debug(f"变量doc_url的值为: {doc_url}")
+            elements.append(cl.File(name=doc_name, url=doc_url))
+        # 打印elements变量的值到终端，方便诊断
+        logger.debug(f"elements变量的值为: {elements}")
+        actions = [
+            cl.Action(
                 name="转人工",
                 icon="mouse-pointer-click",
                 payload={"value": "example_value"},
                 label="点我立即转人工"
             )
         ]
-                # 发送包含文件元素的消息
-                await cl.Message(content="\n\n### 引用文档", elements=elements, actions=actions).send()
-
-            # 明确标记消息完成状态
-            await msg.update()
\ No newline at end of file
+        # 发送包含文件元素的消息
+        await cl.Message(content="\n\n### 引用文档", elements=elements, actions=actions).send()
@@ -0,0 +1,226 @@
+"""
+RAGFlow流式响应（SSE）解析
+功能：增量解码SSE事件，按新增文本计算回答增量，并在流结束时一次性提取引用文档
+"""
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 每个回答最多展示的引用文档数量
+REFERENCE_MAX_DOCS = int(os.getenv('RAGFLOW_REFERENCE_MAX_DOCS', 20))
+
+
+class SSEDecoder:
+    """
+    增量SSE解码器。
+
+    按任意大小的字节块喂入数据，返回已完整接收的事件的data内容。
+    支持多行data帧（按SSE规范以换行拼接），忽略注释行和event/id/retry字段。
+    每个字节只扫描一次，长行分多个块到达时不会重复扫描。
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        # 下一次查找换行符的起始位置（之前的部分已确认不含换行符）
+        self._scan_pos = 0
+        self._data_lines: List[str] = []
+
+    def feed(self, chunk: bytes) -> List[str]:
+        """喂入一个数据块，返回本次新完成的事件data列表"""
+        self._buffer += chunk
+        events: List[str] = []
+        start = 0
+        while True:
+            newline = self._buffer.find(b"\n", self._scan_pos)
+            if newline < 0:
+                break
+            self._process_line(bytes(self._buffer[start:newline]), events)
+            start = self._scan_pos = newline + 1
+        if start:
+            del self._buffer[:start]
+        self._scan_pos = len(self._buffer)
+        return events
+
+    def close(self) -> List[str]:
+        """流结束时调用，返回缓冲区中剩余的事件"""
+        events: List[str] = []
+        if self._buffer:
+            self._process_line(bytes(self._buffer), events)
+            self._buffer.clear()
+            self._scan_pos = 0
+        self._dispatch(events)
+        return events
+
+    def _process_line(self, line: bytes, events: List[str]):
+        line = line.rstrip(b"\r")
+        if not line:
+            # 空行表示一个事件结束
+            self._dispatch(events)
+            return
+        if line.startswith(b":"):
+            return
+        field, _, value = line.partition(b":")
+        if field != b"data":
+            return
+        if value.startswith(b" "):
+            value = value[1:]
+        self._data_lines.append(value.decode("utf-8", errors="replace"))
+
+    def _dispatch(self, events: List[str]):
+        if self._data_lines:
+            events.append("\n".join(self._data_lines))
+            self._data_lines = []
+
+
+def iter_referenced_docs(reference: Dict[str, Any]) -> Iterator[Tuple[str, str]]:
+    """从RAGFlow的reference数据中逐个产出引用文档的(doc_id, doc_name)"""
+    # 优先使用doc_aggs获取聚合的引用文档信息
+    if isinstance(reference.get('doc_aggs'), list):
+        for doc_info in reference['doc_aggs']:
+            yield doc_info.get('doc_id'), doc_info.get('doc_name')
+    # 兼容处理：如果没有doc_aggs则使用chunks（旧版API兼容）
+    elif isinstance(reference.get('chunks'), list):
+        for chunk in reference['chunks']:
+            yield chunk.get('document_id'), chunk.get('document_name')
+
+
+class ReferenceAggregator:
+    """
+    引用文档聚合器。
+
+    按doc_id去重并保持首次出现的顺序，最多保留max_docs个文档，
+    每个文档的访问URL只构造一次。
+    """
+    def __init__(self, max_docs: int = REFERENCE_MAX_DOCS):
+        self.max_docs = max_docs
+        # doc_id -> doc_name（dict保持插入顺序）
+        self._docs: Dict[str, str] = {}
+        self._urls: Dict[str, str] = {}
+        # 因超出数量上限被丢弃的文档数
+        self.dropped = 0
+
+    @classmethod
+    def from_docs(cls, docs: Iterable[Tuple[str, str]], max_docs: int = REFERENCE_MAX_DOCS) -> "ReferenceAggregator":
+        """由(doc_id, doc_name)列表构造，用于回放缓存的回答"""
+        aggregator = cls(max_docs)
+        for doc_id, doc_name in docs:
+            aggregator.add(doc_id, doc_name)
+        return aggregator
+
+    def add(self, doc_id: Optional[str], doc_name: Optional[str]):
+        """添加一个引用文档，重复或缺少ID/名称的文档会被忽略"""
+        if not doc_id or not doc_name or doc_id in self._docs:
+            return
+        if len(self._docs) >= self.max_docs:
+            self.dropped += 1
+            return
+        self._docs[doc_id] = doc_name
+
+    def add_reference(self, reference: Dict[str, Any]):
+        """添加RAGFlow reference数据中的全部引用文档"""
+        for doc_id, doc_name in iter_referenced_docs(reference):
+            self.add(doc_id, doc_name)
+
+    def docs(self) -> List[Tuple[str, str]]:
+        """返回(doc_id, doc_name)列表"""
+        return list(self._docs.items())
+
+    def doc_url(self, base_url: str, doc_id: str) -> str:
+        """返回文档在RAGFlow中的访问URL"""
+        url = self._urls.get(doc_id)
+        if url is None:
+            doc_name = self._docs[doc_id]
+            url = f"{base_url}/document/{doc_id}?ext={doc_name.split('.')[-1]}&prefix=document"
+            self._urls[doc_id] = url
+        return url
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+
+class RAGFlowStreamParser:
+    """
+    RAGFlow completions流式响应解析器。
+
+    RAGFlow每个事件中的answer是截至目前的完整回答，这里只记录已发送的长度，
+    新增内容直接按长度切片得到，不再与已发送内容做整串比较。
+    reference只保留最近一次非空的数据，流结束后再提取一次引用文档。
+    """
+    def __init__(self):
+        self._decoder = SSEDecoder()
+        self.sent_length = 0
+        self.answer = ""
+        self.reference: Optional[Dict[str, Any]] = None
+        self.finished = False
+        self._references: Optional[ReferenceAggregator] = None
+
+    def feed(self, chunk: bytes) -> List[str]:
+        """喂入响应数据块，返回需要推送给前端的新增文本列表"""
+        return self._handle_events(self._decoder.feed(chunk))
+
+    def close(self) -> List[str]:
+        """响应结束时调用，处理缓冲区中剩余的事件"""
+        return self._handle_events(self._decoder.close())
+
+    def references(self) -> ReferenceAggregator:
+        """从最终的reference数据中提取引用文档（只提取一次）"""
+        if self._references is None:
+            self._references = ReferenceAggregator()
+            if self.reference:
+                self._references.add_reference(self.reference)
+        return self._references
+
+    def referenced_docs(self) -> List[Tuple[str, str]]:
+        """返回去重后的(doc_id, doc_name)列表"""
+        return self.references().docs()
+
+    def _handle_events(self, events: List[str]) -> List[str]:
+        deltas = []
+        for data in events:
+            if self.finished:
+                break
+            for json_data in self._loads(data):
+                delta = self._handle_event(json_data)
+                if delta:
+                    deltas.append(delta)
+        return deltas
+
+    @staticmethod
+    def _loads(data: str) -> List[Any]:
+        try:
+            return [json.loads(data)]
+        except json.JSONDecodeError:
+            pass
+        # 兼容事件之间缺少空行的情况：逐行解析
+        parsed = []
+        for line in data.split("\n"):
+            try:
+                parsed.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.debug(f"忽略无法解析的SSE数据: {line[:100]}")
+        return parsed
+
+    def _handle_event(self, json_data: Any) -> str:
+        if not isinstance(json_data, dict) or json_data.get('code') != 0:
+            return ""
+        data = json_data.get('data')
+        # 检查是否为结束标志
+        if data is True:
+            self.finished = True
+            return ""
+        if not isinstance(data, dict):
+            return ""
+
+        reference = data.get('reference')
+        if reference:
+            self.reference = reference
+
+        answer = data.get('answer') or ""
+        if len(answer) <= self.sent_length:
+            return ""
+        delta = answer[self.sent_length:]
+        self.sent_length = len(answer)
+        self.answer = answer
+        return delta
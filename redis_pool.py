@@ -0,0 +1,204 @@
+﻿"""
+进程级共享的Redis连接池
+功能：webhook服务、Chainlit应用和回答缓存从同一个连接池取连接（同步和asyncio客户端各一个池，
+另有读取二进制消息流的原始字节连接池，与对应的连接池共用连接数上限），
+连接数上限、超时、健康检查和TCP keepalive均可配置，并统计使用中/空闲连接数和等待时间
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import redis
+import redis.asyncio
+
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 每个进程同步客户端和asyncio客户端各自的最大连接数，由返回文本和返回原始字节的两个连接池分配；
+# 每个进程最多2*REDIS_MAX_CONNECTIONS个连接，--workers N时为2*N*REDIS_MAX_CONNECTIONS，应小于Redis的maxclients
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 100))
+# 其中分给原始字节连接池（只用于XREAD读取消息流）的连接数，其余归返回文本的连接池
+REDIS_RAW_MAX_CONNECTIONS = int(os.getenv('REDIS_RAW_MAX_CONNECTIONS', 10))
+# 连接池用尽时等待空闲连接的最长时间（秒），超时抛出ConnectionError
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 20))
+# 建立连接的超时时间（秒）
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', 5))
+# 读写超时（秒），不设置表示不限制；设置时必须大于最长的阻塞读取时间（XREAD/BLPOP的timeout）
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT')) if os.getenv('REDIS_SOCKET_TIMEOUT') else None
+# 空闲连接超过该秒数后再次使用前先做健康检查，0表示不检查
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+REDIS_SOCKET_KEEPALIVE = os.getenv('REDIS_SOCKET_KEEPALIVE', 'true').lower() == 'true'
+
+# (host, port, db, password, decode_responses) -> 连接池
+PoolKey = Tuple[str, int, int, Optional[str], bool]
+
+
+class PoolStats:
+    """连接池使用情况：已创建、使用中、空闲的连接数和获取连接的等待时间"""
+    def __init__(self, name: str, max_connections: int):
+        self.name = name
+        self.max_connections = max_connections
+        self.created = 0
+        self.in_use = 0
+        # 连接已确认可用（启动时只ping一次）
+        self.verified = False
+        self._lock = threading.Lock()
+
+    def connection_created(self):
+        with self._lock:
+            self.created += 1
+        self._update_gauges()
+
+    def acquired(self, wait_seconds: float):
+        with self._lock:
+            self.in_use += 1
+        metrics.observe(f"redis.pool.{self.name}.wait_seconds", wait_seconds)
+        self._update_gauges()
+
+    def released(self):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+        self._update_gauges()
+
+    def to_dict(self) -> dict:
+        return {
+            "max_connections": self.max_connections,
+            "created": self.created,
+            "in_use": self.in_use,
+            "idle": max(0, self.created - self.in_use),
+        }
+
+    def _update_gauges(self):
+        metrics.set_gauge(f"redis.pool.{self.name}.in_use", self.in_use)
+        metrics.set_gauge(f"redis.pool.{self.name}.idle", max(0, self.created - self.in_use))
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """带使用统计的同步阻塞连接池：连接用尽时等待而不是继续新建连接"""
+    def __init__(self, name: str, **kwargs):
+        self.stats = PoolStats(name, kwargs.get("max_connections", REDIS_MAX_CONNECTIONS))
+        super().__init__(**kwargs)
+
+    def make_connection(self):
+        connection = super().make_connection()
+        self.stats.connection_created()
+        return connection
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        connection = super().get_connection(*args, **kwargs)
+        self.stats.acquired(time.perf_counter() - start)
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        self.stats.released()
+
+
+class InstrumentedAsyncConnectionPool(redis.asyncio.BlockingConnectionPool):
+    """带使用统计的asyncio阻塞连接池"""
+    def __init__(self, name: str, **kwargs):
+        self.stats = PoolStats(name, kwargs.get("max_connections", REDIS_MAX_CONNECTIONS))
+        super().__init__(**kwargs)
+
+    def make_connection(self):
+        connection = super().make_connection()
+        self.stats.connection_created()
+        return connection
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        connection = await super().get_connection(*args, **kwargs)
+        self.stats.acquired(time.perf_counter() - start)
+        return connection
+
+    async def release(self, connection):
+        await super().release(connection)
+        self.stats.released()
+
+
+_pools: Dict[PoolKey, InstrumentedConnectionPool] = {}
+_async_pools: Dict[PoolKey, InstrumentedAsyncConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _max_connections(decode_responses: bool) -> int:
+    """
+    在返回文本和原始字节的连接池之间分配REDIS_MAX_CONNECTIONS，两者之和不超过上限（上限小于2时各1个）；
+    原始字节连接池最多分到一半
+    """
+    raw = max(1, min(REDIS_RAW_MAX_CONNECTIONS, REDIS_MAX_CONNECTIONS // 2))
+    return max(1, REDIS_MAX_CONNECTIONS - raw) if decode_responses else raw
+
+
+def _pool_kwargs(host: str, port: int, db: int, password: Optional[str], decode_responses: bool) -> dict:
+    return {
+        "host": host,
+        "port": port,
+        "db": db,
+        "password": password,
+        "decode_responses": decode_responses,
+        "max_connections": _max_connections(decode_responses),
+        "timeout": REDIS_POOL_TIMEOUT,
+        "socket_connect_timeout": REDIS_SOCKET_CONNECT_TIMEOUT,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_keepalive": REDIS_SOCKET_KEEPALIVE,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+    }
+
+
+def _pool_name(kind: str, db: int, decode_responses: bool) -> str:
+    return f"{kind}.db{db}" + ("" if decode_responses else ".raw")
+
+
+def get_connection_pool(
+    host: str, port: int, db: int, password: Optional[str] = None, decode_responses: bool = True
+) -> InstrumentedConnectionPool:
+    """
+    获取同步客户端使用的进程级连接池（相同地址和数据库只创建一次）。
+    decode_responses=False的连接池返回原始字节，用于读取二进制编码的消息。
+    """
+    key = (host, port, db, password, decode_responses)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = InstrumentedConnectionPool(
+                _pool_name("sync", db, decode_responses), **_pool_kwargs(host, port, db, password, decode_responses)
+            )
+            _pools[key] = pool
+            logger.info(f"创建Redis连接池{pool.stats.name}: {host}:{port}/{db}, 最大连接数{pool.stats.max_connections}")
+    return pool
+
+
+def get_async_connection_pool(
+    host: str, port: int, db: int, password: Optional[str] = None, decode_responses: bool = True
+) -> InstrumentedAsyncConnectionPool:
+    """获取asyncio客户端使用的进程级连接池（相同地址和数据库只创建一次）"""
+    key = (host, port, db, password, decode_responses)
+    with _pools_lock:
+        pool = _async_pools.get(key)
+        if pool is None:
+            pool = InstrumentedAsyncConnectionPool(
+                _pool_name("async", db, decode_responses), **_pool_kwargs(host, port, db, password, decode_responses)
+            )
+            _async_pools[key] = pool
+            logger.info(f"创建Redis异步连接池{pool.stats.name}: {host}:{port}/{db}, 最大连接数{pool.stats.max_connections}")
+    return pool
+
+
+def pool_stats() -> dict:
+    """所有连接池的使用情况，供/metrics输出"""
+    with _pools_lock:
+        pools = list(_pools.values()) + list(_async_pools.values())
+    return {pool.stats.name: pool.stats.to_dict() for pool in pools}
+
+
+async def close_async_pools():
+    """关闭所有asyncio连接池（服务关闭时调用）"""
+    with _pools_lock:
+        pools = list(_async_pools.values())
+        _async_pools.clear()
+    for pool in pools:
+        await pool.disconnect()
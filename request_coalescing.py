@@ -0,0 +1,156 @@
+"""
+相同问题的请求合并
+功能：同一助手的相同问题正在生成回答时，后来的提问不再单独请求RAGFlow，
+而是订阅同一个上游流：先回放已生成的内容，再接收后续增量
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+REQUEST_COALESCING_ENABLED = os.getenv('REQUEST_COALESCING_ENABLED', 'true').lower() == 'true'
+
+# 上游生产者：接收emit回调逐个提交增量，返回最终结果（如解析器）
+Producer = Callable[[Callable[[str], None]], Awaitable[Any]]
+
+
+class SharedStream:
+    """
+    一个正在进行的上游流。
+
+    上游产生的增量全部保存在chunks中，每个订阅者各自维护读取位置，
+    上游从不等待订阅者：读得慢的订阅者下次会一次取走积压的全部内容，不影响其他订阅者。
+    """
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.result: Any = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def emit(self, delta: str):
+        """上游提交一个增量"""
+        if delta:
+            self.chunks.append(delta)
+            self._notify()
+
+    def finish(self, result: Any = None, error: Optional[BaseException] = None):
+        self.result = result
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        # 每次变化换一个新的Event，已在等待的订阅者全部被唤醒
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_changed(self):
+        await self._changed.wait()
+
+
+class Subscription:
+    """SharedStream的一个订阅者，迭代得到增量文本，迭代结束后通过result获取上游结果"""
+    def __init__(self, stream: SharedStream, leader: bool):
+        self.stream = stream
+        # 是否由本次订阅发起上游请求
+        self.leader = leader
+        self.cursor = 0
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._iter()
+
+    async def _iter(self) -> AsyncIterator[str]:
+        stream = self.stream
+        while True:
+            if self.cursor < len(stream.chunks):
+                # 回放或追赶时把积压的增量合并成一段
+                end = len(stream.chunks)
+                text = "".join(stream.chunks[self.cursor:end])
+                self.cursor = end
+                yield text
+            elif stream.done:
+                if stream.error is not None:
+                    raise stream.error
+                return
+            else:
+                await stream.wait_changed()
+
+    @property
+    def result(self) -> Any:
+        if self.stream.error is not None:
+            raise self.stream.error
+        return self.stream.result
+
+
+class RequestCoalescer:
+    """
+    按key合并进行中的上游请求。
+
+    第一个订阅者启动上游任务，之后相同key的订阅者直接加入；上游任务独立于任何订阅者运行，
+    发起者离开不影响其他订阅者，所有订阅者都离开后才取消上游请求。
+    上游结束后立即移除该key，之后的相同请求会重新发起（通常已能命中回答缓存）。
+
+    用法：
+        async with coalescer.subscribe(key, producer) as subscription:
+            async for delta in subscription:
+                ...
+        result = subscription.result
+    """
+    def __init__(self):
+        self._inflight: Dict[Hashable, SharedStream] = {}
+
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    @asynccontextmanager
+    async def subscribe(self, key: Hashable, producer: Producer) -> AsyncIterator[Subscription]:
+        stream = self._inflight.get(key)
+        leader = stream is None
+        if leader:
+            stream = SharedStream(key)
+            self._inflight[key] = stream
+            stream.task = asyncio.create_task(self._run(stream, producer))
+            metrics.incr("coalescing.leaders")
+        else:
+            metrics.incr("coalescing.followers")
+            logger.info(f"相同问题正在生成回答，加入已有的上游流: 已生成{len(stream.chunks)}段")
+        metrics.set_gauge("coalescing.inflight", len(self._inflight))
+
+        stream.subscribers += 1
+        try:
+            yield Subscription(stream, leader)
+        finally:
+            stream.subscribers -= 1
+            if not stream.subscribers and not stream.done:
+                logger.info("请求合并：所有订阅者都已离开，取消上游请求")
+                # 立即移除，取消生效前到达的相同请求会重新发起
+                if self._inflight.get(key) is stream:
+                    del self._inflight[key]
+                stream.task.cancel()
+
+    async def _run(self, stream: SharedStream, producer: Producer):
+        try:
+            result = await producer(stream.emit)
+        except asyncio.CancelledError as e:
+            stream.finish(error=e)
+            raise
+        except Exception as e:
+            stream.finish(error=e)
+        else:
+            stream.finish(result)
+        finally:
+            if self._inflight.get(stream.key) is stream:
+                del self._inflight[stream.key]
+            metrics.set_gauge("coalescing.inflight", len(self._inflight))
+
+
+# 进程级共享的请求合并器
+request_coalescer = RequestCoalescer()
@@ -0,0 +1,135 @@
+"""
+上游调用的故障隔离
+功能：熔断器（上游持续失败时快速失败，并定期放行探测请求检查是否恢复）和带随机抖动的重试
+"""
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Tuple, Type, TypeVar
+
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+T = TypeVar("T")
+
+# 熔断器状态
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+# 指标中使用的状态数值
+_STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发出"""
+
+
+class CircuitBreaker:
+    """
+    熔断器。
+
+    - closed：正常放行，连续失败达到failure_threshold次后进入open；
+    - open：直接抛出CircuitOpenError，recovery_timeout秒后进入half_open；
+    - half_open：最多放行half_open_max_calls个探测请求，成功则恢复closed，失败则重新open。
+
+    只有failure_exceptions中的异常计为失败（如网络错误、超时），业务错误不影响熔断状态。
+    """
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30,
+        half_open_max_calls: int = 1,
+        failure_exceptions: Tuple[Type[BaseException], ...] = (Exception,),
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.failure_exceptions = failure_exceptions
+        self.state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        metrics.set_gauge(f"circuit.{self.name}.state", _STATE_VALUES[self.state])
+
+    def is_open(self) -> bool:
+        """当前是否会拒绝请求（open且尚未到探测时间）"""
+        return self.state == STATE_OPEN and time.monotonic() - self._opened_at < self.recovery_timeout
+
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        """在熔断器保护下执行一次调用"""
+        self._before_call()
+        probe = self.state == STATE_HALF_OPEN
+        try:
+            yield
+        except self.failure_exceptions as e:
+            self._record_failure(e)
+            raise
+        else:
+            # 其他异常（业务错误、调用方取消）既不计为成功也不计为失败
+            self._record_success()
+        finally:
+            if probe:
+                self._half_open_calls = max(0, self._half_open_calls - 1)
+
+    def _before_call(self):
+        if self.state == STATE_OPEN:
+            if time.monotonic() - self._opened_at < self.recovery_timeout:
+                metrics.incr(f"circuit.{self.name}.rejected")
+                raise CircuitOpenError(f"{self.name}暂时不可用（熔断中）")
+            self._transition(STATE_HALF_OPEN)
+        if self.state == STATE_HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                metrics.incr(f"circuit.{self.name}.rejected")
+                raise CircuitOpenError(f"{self.name}暂时不可用（正在探测恢复）")
+            self._half_open_calls += 1
+
+    def _record_success(self):
+        self._failures = 0
+        if self.state != STATE_CLOSED:
+            self._transition(STATE_CLOSED)
+
+    def _record_failure(self, error: BaseException):
+        self._failures += 1
+        metrics.incr(f"circuit.{self.name}.failures")
+        if self.state == STATE_HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != STATE_OPEN:
+                logger.error(f"{self.name}连续失败{self._failures}次，熔断{self.recovery_timeout}秒: {error!r}")
+            self._opened_at = time.monotonic()
+            self._transition(STATE_OPEN)
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        logger.warning(f"熔断器{self.name}状态变化: {self.state} -> {state}")
+        self.state = state
+        if state == STATE_OPEN:
+            metrics.incr(f"circuit.{self.name}.opened")
+        metrics.set_gauge(f"circuit.{self.name}.state", _STATE_VALUES[state])
+
+
+async def retry_async(
+    func: Callable[[], Awaitable[T]],
+    attempts: int = 3,
+    base_delay: float = 0.2,
+    max_delay: float = 2.0,
+    retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+) -> T:
+    """
+    重试异步调用，等待时间按指数增长并加入完全随机抖动（full jitter），
+    避免大量请求在同一时刻重试。只应用于幂等调用。
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await func()
+        except retry_on as e:
+            if attempt >= attempts:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            logger.warning(f"调用失败（第{attempt}次），{delay:.2f}秒后重试: {e!r}")
+            metrics.incr("retry.attempts")
+            await asyncio.sleep(delay)
@@ -0,0 +1,158 @@
+"""
+Redis数据保留与内存统计
+功能：为转人工消息流和会话元数据设置过期时间，定期用SCAN分批清理没有过期时间的遗留键和已失效的队列索引，
+并按前缀统计键数量和内存占用（/retention和/metrics输出），避免共享Redis的内存随转人工次数持续增长
+"""
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from message_queue import QUEUE_TYPES, SCAN_COUNT, STREAM_TTL, registry_key
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 会话元数据（chainlit_session:*:metadata）的过期时间（秒），会话有活动时刷新
+SESSION_METADATA_TTL = int(os.getenv('SESSION_METADATA_TTL', 86400))
+# 会话结束后其人工客服消息流的保留时间（秒）；客服再次回复时恢复为REDIS_STREAM_TTL
+HANDOFF_ENDED_STREAM_TTL = int(os.getenv('HANDOFF_ENDED_STREAM_TTL', 3600))
+# 清理间隔（秒），0表示不运行后台清理
+RETENTION_SWEEP_INTERVAL = float(os.getenv('RETENTION_SWEEP_INTERVAL', 3600))
+# 每个前缀统计内存时最多抽样的键数（MEMORY USAGE），键数更多时按抽样均值估算
+RETENTION_MEMORY_SAMPLE = int(os.getenv('RETENTION_MEMORY_SAMPLE', 200))
+
+
+def default_rules() -> List[Tuple[str, str, Optional[int]]]:
+    """(名称, 键前缀, 过期时间)；过期时间为None的前缀只统计不设置过期时间"""
+    environment = os.getenv('IT_ENVIRONMENT')
+    return [
+        ("handoff_streams", f"{environment}:rocket.chat_session:", STREAM_TTL),
+        ("session_metadata", "chainlit_session:", SESSION_METADATA_TTL),
+        ("answer_cache", f"{environment}:answer_cache:", None),
+        ("session_directory", f"{environment}:session_directory:", None),
+    ]
+
+
+class RetentionSweeper:
+    """
+    按前缀清理和统计Redis键。
+
+    每轮清理：
+    1. 用SCAN（每批SCAN_COUNT个键）找出前缀下没有过期时间的键并补上过期时间，
+       处理设置过期时间之前遗留的消息流和元数据；
+    2. 从队列索引中删除已经过期或被删除的队列；
+    3. 统计每个前缀的键数量和内存占用。
+    所有命令按批次流水线执行，不使用KEYS，不会长时间阻塞Redis。
+    """
+    def __init__(self, client: redis.Redis, rules: Optional[List[Tuple[str, str, Optional[int]]]] = None,
+                 scan_count: int = SCAN_COUNT, memory_sample: int = RETENTION_MEMORY_SAMPLE):
+        self.client = client
+        self.rules = rules if rules is not None else default_rules()
+        self.scan_count = scan_count
+        self.memory_sample = memory_sample
+        # 服务端禁用了MEMORY命令时不再统计内存
+        self.memory_supported = True
+        # 最近一次清理的结果，供/retention查询
+        self.last_report: Dict[str, dict] = {}
+
+    def sweep(self) -> Dict[str, dict]:
+        """执行一轮清理并返回各前缀的统计"""
+        start = time.perf_counter()
+        report = {name: self._sweep_prefix(name, prefix, ttl) for name, prefix, ttl in self.rules}
+        report["queue_registry"] = {"pruned": self.prune_registry()}
+        self.last_report = report
+        metrics.observe("retention.sweep_seconds", time.perf_counter() - start)
+        logger.info(f"Redis数据清理完成: {report}")
+        return report
+
+    def _sweep_prefix(self, name: str, prefix: str, ttl: Optional[int]) -> dict:
+        keys = 0
+        expired_set = 0
+        sampled_bytes = 0
+        sampled = 0
+        for batch in self._scan(prefix):
+            keys += len(batch)
+            pipe = self.client.pipeline(transaction=False)
+            for key in batch:
+                pipe.ttl(key)
+            sample = batch[:max(0, self.memory_sample - sampled)] if self.memory_supported else []
+            for key in sample:
+                pipe.memory_usage(key)
+            results = pipe.execute(raise_on_error=False)
+            ttls, usages = results[:len(batch)], results[len(batch):]
+            error = next((usage for usage in usages if isinstance(usage, redis.ResponseError)), None)
+            if error is not None:
+                logger.warning(f"Redis不支持MEMORY USAGE，停止统计内存: {error}")
+                self.memory_supported = False
+                usages = []
+            sampled += len(usages)
+            sampled_bytes += sum(usage or 0 for usage in usages)
+            # TTL为-1表示键没有过期时间（-2表示键已不存在）
+            persistent = [key for key, key_ttl in zip(batch, ttls) if key_ttl == -1]
+            if ttl and persistent:
+                pipe = self.client.pipeline(transaction=False)
+                for key in persistent:
+                    pipe.expire(key, ttl)
+                pipe.execute()
+                expired_set += len(persistent)
+        memory_bytes = round(sampled_bytes / sampled * keys) if sampled else None
+        metrics.set_gauge(f"retention.{name}.keys", keys)
+        if memory_bytes is not None:
+            metrics.set_gauge(f"retention.{name}.memory_bytes", memory_bytes)
+        if expired_set:
+            metrics.incr(f"retention.{name}.expire_set", expired_set)
+        return {
+            "prefix": prefix,
+            "keys": keys,
+            "memory_bytes": memory_bytes,
+            "memory_estimated": memory_bytes is not None and sampled < keys,
+            "expire_set": expired_set,
+        }
+
+    def _scan(self, prefix: str):
+        cursor = 0
+        while True:
+            cursor, keys = self.client.scan(cursor, match=f"{prefix}*", count=self.scan_count)
+            if keys:
+                yield keys
+            if cursor == 0:
+                return
+
+    def prune_registry(self) -> int:
+        """从队列索引中删除已不存在的队列，返回删除数量"""
+        pruned = 0
+        for key_type in QUEUE_TYPES:
+            index = registry_key(key_type)
+            start = 0
+            while True:
+                names = self.client.zrange(index, start, start + self.scan_count - 1)
+                if not names:
+                    break
+                pipe = self.client.pipeline(transaction=False)
+                for name in names:
+                    pipe.exists(name)
+                missing = [name for name, exists in zip(names, pipe.execute()) if not exists]
+                if missing:
+                    self.client.zrem(index, *missing)
+                    pruned += len(missing)
+                start += len(names) - len(missing)
+        if pruned:
+            metrics.incr("retention.registry_pruned", pruned)
+        return pruned
+
+
+async def run_retention_loop(sweeper, interval: float = RETENTION_SWEEP_INTERVAL):
+    """后台定期清理（在线程中执行，不阻塞事件循环）；sweeper为RetentionSweeper或进程内队列的MemoryStore"""
+    if interval <= 0:
+        logger.info("未启用Redis数据定期清理")
+        return
+    while True:
+        try:
+            await asyncio.to_thread(sweeper.sweep)
+        except redis.RedisError as e:
+            logger.error(f"Redis数据清理失败: {e}")
+            metrics.incr("retention.errors")
+        await asyncio.sleep(interval)
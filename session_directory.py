@@ -0,0 +1,135 @@
+"""
+多工作进程/多节点部署的会话目录
+功能：在Redis中记录每个转人工会话的人工客服消息流由哪个工作进程负责投递，
+工作进程定期发送心跳，心跳停止后记录自动过期；webhook写入客服回复时向负责的工作进程的收件箱
+（每个工作进程一个消息流）发送通知，工作进程只阻塞读取自己的收件箱，只读取收到通知的消息流，
+不需要轮询其他工作进程负责的消息流
+"""
+import os
+import socket
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Set
+
+import redis.asyncio
+
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 是否启用会话目录（需要Redis后端；多个工作进程或多个节点部署时启用）
+SESSION_DIRECTORY_ENABLED = os.getenv('SESSION_DIRECTORY_ENABLED', 'false').lower() == 'true'
+# 目录记录的有效期（秒），工作进程停止心跳超过该时间后不再接收通知
+SESSION_DIRECTORY_TTL = int(os.getenv('SESSION_DIRECTORY_TTL', 60))
+# 心跳间隔（秒），应明显小于SESSION_DIRECTORY_TTL
+SESSION_HEARTBEAT_INTERVAL = float(os.getenv('SESSION_HEARTBEAT_INTERVAL', 20))
+# 本工作进程的标识，不设置时由主机名、进程号和随机后缀组成（重启后不同）
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class SessionDirectory:
+    """
+    Redis中的会话目录。
+
+    键（均带过期时间，由心跳刷新）：
+    - {prefix}:room:{消息流}    有序集合，成员为负责该消息流的工作进程，分数为记录的过期时间
+    - {prefix}:worker:{工作进程} 工作进程信息（节点、进程号、会话数、最后心跳时间）
+    - {prefix}:inbox:{工作进程}  工作进程收件箱，每条通知的消息体为有新消息的消息流名称
+    """
+    def __init__(self, client: redis.asyncio.Redis, worker_id: str = WORKER_ID, ttl: int = SESSION_DIRECTORY_TTL,
+                 heartbeat_interval: float = SESSION_HEARTBEAT_INTERVAL, prefix: Optional[str] = None):
+        self.client = client
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.prefix = prefix or f"{os.getenv('IT_ENVIRONMENT')}:session_directory"
+        # 本工作进程已登记的消息流
+        self._owned: Set[str] = set()
+        self._next_heartbeat = 0.0
+
+    def room_key(self, stream_name: str) -> str:
+        return f"{self.prefix}:room:{stream_name}"
+
+    def worker_key(self, worker_id: str) -> str:
+        return f"{self.prefix}:worker:{worker_id}"
+
+    def inbox_key(self, worker_id: Optional[str] = None) -> str:
+        return f"{self.prefix}:inbox:{worker_id or self.worker_id}"
+
+    async def sync(self, streams: Dict[str, Set[str]]) -> Set[str]:
+        """
+        使目录与本工作进程当前的订阅一致：登记新的消息流、删除已取消的，到时间时发送心跳。
+
+        Args:
+            streams: 消息流 -> 订阅该消息流的会话ID（心跳时记录会话数）
+
+        Returns:
+            需要立即读取一次的消息流：新登记的（登记前到达的消息没有通知），心跳时为全部
+            （补上目录查询与登记之间可能错过的通知）
+        """
+        now = time.time()
+        heartbeat = now >= self._next_heartbeat
+        new = set(streams) - self._owned
+        gone = self._owned - set(streams)
+        if not (heartbeat or new or gone):
+            return set()
+
+        expires_at = now + self.ttl
+        pipe = self.client.pipeline(transaction=False)
+        for stream_name in streams:
+            if heartbeat or stream_name in new:
+                pipe.zadd(self.room_key(stream_name), {self.worker_id: expires_at})
+                pipe.expire(self.room_key(stream_name), self.ttl)
+        for stream_name in gone:
+            pipe.zrem(self.room_key(stream_name), self.worker_id)
+        if heartbeat:
+            pipe.hset(self.worker_key(self.worker_id), mapping={
+                "node": socket.gethostname(),
+                "pid": os.getpid(),
+                "sessions": sum(len(s) for s in streams.values()),
+                "heartbeat_at": now,
+            })
+            pipe.expire(self.worker_key(self.worker_id), self.ttl)
+        await pipe.execute()
+
+        self._owned = set(streams)
+        if heartbeat:
+            self._next_heartbeat = now + self.heartbeat_interval
+            metrics.incr("directory.heartbeats")
+            return set(streams)
+        return new
+
+    async def release_all(self):
+        """删除本工作进程的全部登记（没有订阅时或关闭时调用）"""
+        if self._owned:
+            await self.sync({})
+
+    async def owners(self, stream_names: Iterable[str]) -> Dict[str, List[str]]:
+        """查询负责各消息流的工作进程（记录未过期的），一次往返"""
+        stream_names = list(stream_names)
+        if not stream_names:
+            return {}
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for stream_name in stream_names:
+            pipe.zrangebyscore(self.room_key(stream_name), now, "+inf")
+        return {name: workers for name, workers in zip(stream_names, await pipe.execute()) if workers}
+
+    async def notifications(self, stream_names: Iterable[str]) -> Dict[str, List[str]]:
+        """收件箱 -> 需要通知的消息流，供写入客服回复时一并发送"""
+        inboxes: Dict[str, List[str]] = {}
+        for stream_name, workers in (await self.owners(stream_names)).items():
+            for worker_id in workers:
+                inboxes.setdefault(self.inbox_key(worker_id), []).append(stream_name)
+        return inboxes
+
+
+def create_session_directory(queue) -> Optional[SessionDirectory]:
+    """按配置为异步消息队列创建会话目录；未启用或使用进程内队列（没有Redis连接）时返回None"""
+    if not SESSION_DIRECTORY_ENABLED:
+        return None
+    if queue.client is None:
+        logger.warning("会话目录需要Redis后端，进程内消息队列不启用会话目录")
+        return None
+    logger.info(f"启用会话目录，工作进程标识: {WORKER_ID}")
+    return SessionDirectory(queue.client)
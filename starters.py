@@ -0,0 +1,26 @@
+"""
+Chainlit首页的快捷提问（Starter）
+Chainlit应用用它渲染首页按钮，webhook_server启动预热时用它预先生成回答
+"""
+STARTERS = [
+    {
+        "label": "AI助手使用手册",
+        "message": "AI助手使用手册.",
+        "icon": "http://10.64.160.146/arrow-right-circle-line.svg",
+    },
+    {
+        "label": "如何重置密码",
+        "message": "如何重置密码.",
+        "icon": "http://10.64.160.146/arrow-right-circle-line.svg",
+    },
+    {
+        "label": "公司食堂开餐时间",
+        "message": "公司食堂开餐时间.",
+        "icon": "http://10.64.160.146/arrow-right-circle-line.svg",
+    },
+    {
+        "label": "怎么查打卡时间",
+        "message": "怎么查打卡时间.",
+        "icon": "http://10.64.160.146/arrow-right-circle-line.svg",
+    },
+]
@@ -0,0 +1,279 @@
+"""
+人工客服消息流的统一分发
+功能：每个工作进程只运行一个分发任务，用一次多键XREAD读取所有转人工会话的消息流，
+再按消息流把消息路由给登记的会话；Redis连接数和线程数不随会话数量增长。
+webhook收到的回复如果属于本进程中的会话，还会通过local_bus直接投递，不等待Redis往返，
+之后从Redis读到的同一条消息按message_id去重。
+启用会话目录（session_directory.py）时，分发任务只阻塞读取本工作进程的收件箱，
+收到通知后再读取对应的消息流
+"""
+import asyncio
+import contextvars
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import redis
+
+from message_queue import AsyncRedisQueue, STREAM_READ_COUNT
+from session_directory import SessionDirectory
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 每次XREAD的最长阻塞时间（毫秒）；新登记的会话最迟在一个阻塞周期后开始被读取
+DISPATCHER_BLOCK_MS = int(os.getenv('STREAM_DISPATCHER_BLOCK_MS', 1000))
+# Redis出错后重试前的等待时间（秒）
+DISPATCHER_RETRY_DELAY = float(os.getenv('STREAM_DISPATCHER_RETRY_DELAY', 1))
+# 每个订阅记住的最近投递的message_id数量（用于去重）
+DISPATCHER_DEDUP_SIZE = int(os.getenv('STREAM_DISPATCHER_DEDUP_SIZE', 1000))
+
+
+def _parse_id(stream_id: str) -> Tuple[int, int]:
+    milliseconds, _, sequence = stream_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+class StreamSubscription:
+    """
+    一个会话对一个消息流的订阅。
+
+    分发任务把新消息放入本订阅的队列，会话在自己的任务（Chainlit会话上下文）中取出并发送，
+    发送慢的会话不会拖慢分发任务和其他会话。
+    """
+    def __init__(self, stream_name: str, cursor: str, session_id: Optional[str] = None):
+        self.stream_name = stream_name
+        self.session_id = session_id
+        # 已放入队列的最后一条消息ID
+        self.cursor = cursor
+        self.queue: "asyncio.Queue[List[dict]]" = asyncio.Queue()
+        # 最近投递过的message_id（本地直接投递和Redis读取共用），避免同一条消息显示两次
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+
+    async def next_batch(self) -> List[dict]:
+        """等待并返回下一批消息（按ID从小到大）"""
+        batch = await self.queue.get()
+        # 合并已经积压的批次
+        while not self.queue.empty():
+            batch.extend(self.queue.get_nowait())
+        return batch
+
+    def _first_delivery(self, message_id: str) -> bool:
+        """记录message_id，已经投递过时返回False；没有message_id的消息不去重"""
+        if not message_id:
+            return True
+        if message_id in self._seen:
+            return False
+        self._seen[message_id] = None
+        if len(self._seen) > DISPATCHER_DEDUP_SIZE:
+            self._seen.popitem(last=False)
+        return True
+
+    def _route(self, entries: List[dict]):
+        cursor = _parse_id(self.cursor)
+        new_entries = [entry for entry in entries if _parse_id(entry["id"]) > cursor]
+        if new_entries:
+            self.cursor = new_entries[-1]["id"]
+            new_entries = [entry for entry in new_entries if self._first_delivery(entry["message"].message_id)]
+            if new_entries:
+                self.queue.put_nowait(new_entries)
+
+    def _deliver_local(self, message: Any) -> bool:
+        # 还没有消息流ID，id为None；message提供与LazyMessage相同的body/sender/message_id属性
+        if not self._first_delivery(message.message_id):
+            return False
+        self.queue.put_nowait([{"id": None, "message": message}])
+        return True
+
+
+class LocalDeliveryBus:
+    """
+    进程内的会话投递总线：消息流名称 -> 本进程中订阅该消息流的会话。
+
+    Chainlit应用挂载在webhook服务的同一进程中，webhook收到回复后调用publish，
+    目标会话在本进程时直接放入其订阅队列；回复仍会写入Redis，供其他工作进程中的会话读取和持久保存。
+    """
+    def __init__(self):
+        self._subscriptions: Dict[str, Set[StreamSubscription]] = {}
+
+    def register(self, subscription: StreamSubscription):
+        self._subscriptions.setdefault(subscription.stream_name, set()).add(subscription)
+
+    def unregister(self, subscription: StreamSubscription):
+        subscriptions = self._subscriptions.get(subscription.stream_name)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.stream_name]
+
+    def publish(self, stream_name: str, message: Any) -> int:
+        """
+        把消息直接投递给本进程中订阅该消息流的会话，返回投递的会话数。
+        没有message_id的消息无法与之后从Redis读到的同一条消息去重，不走本地投递。
+        """
+        if not message.message_id:
+            return 0
+        delivered = sum(
+            1 for subscription in list(self._subscriptions.get(stream_name, ()))
+            if subscription._deliver_local(message)
+        )
+        if delivered:
+            metrics.incr("dispatcher.local_delivered", delivered)
+        return delivered
+
+
+# 进程级投递总线：webhook服务和Chainlit应用通过它共享本进程的会话订阅
+local_bus = LocalDeliveryBus()
+
+
+class StreamDispatcher:
+    """
+    多个消息流的统一读取与分发。
+
+    用法：
+        subscription = dispatcher.subscribe(stream_name, cursor)
+        try:
+            while True:
+                for entry in await subscription.next_batch():
+                    ...
+        finally:
+            dispatcher.unsubscribe(subscription)
+    """
+    def __init__(self, queue: AsyncRedisQueue, block_ms: int = DISPATCHER_BLOCK_MS, count: int = STREAM_READ_COUNT,
+                 bus: Optional[LocalDeliveryBus] = local_bus, directory: Optional[SessionDirectory] = None):
+        self.queue = queue
+        self.block_ms = block_ms
+        self.count = count
+        self.bus = bus
+        self.directory = directory
+        # 会话目录模式：收件箱的读取位置，以及收到通知、需要读取的消息流
+        self._inbox_cursor: Optional[str] = None
+        self._pending: Set[str] = set()
+        # 消息流 -> 订阅该消息流的会话
+        self._subscriptions: Dict[str, Set[StreamSubscription]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, stream_name: str, cursor: str, session_id: Optional[str] = None) -> StreamSubscription:
+        """登记一个订阅，从cursor之后的消息开始投递；session_id用于在会话目录中登记"""
+        subscription = StreamSubscription(stream_name, cursor, session_id)
+        self._subscriptions.setdefault(stream_name, set()).add(subscription)
+        if self.bus is not None:
+            self.bus.register(subscription)
+        self._update_gauges()
+        self._ensure_running()
+        self._wakeup.set()
+        logger.info(f"登记消息流订阅: {stream_name}, 起始位置: {cursor}")
+        return subscription
+
+    def unsubscribe(self, subscription: StreamSubscription):
+        """取消订阅（会话结束时调用）"""
+        if self.bus is not None:
+            self.bus.unregister(subscription)
+        subscriptions = self._subscriptions.get(subscription.stream_name)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.stream_name]
+        self._update_gauges()
+        logger.info(f"取消消息流订阅: {subscription.stream_name}")
+
+    async def close(self):
+        """停止分发任务"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            # 在空上下文中运行，不继承发起登记的Chainlit会话的上下文
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    def _cursors(self) -> Dict[str, str]:
+        # 同一消息流有多个订阅时从最早的位置读取，各订阅再按自己的位置过滤
+        return {
+            stream_name: min((s.cursor for s in subscriptions), key=_parse_id)
+            for stream_name, subscriptions in self._subscriptions.items()
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                if not self._subscriptions:
+                    if self.directory is not None:
+                        await self.directory.release_all()
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                if self.directory is not None:
+                    results = await self._read_via_inbox()
+                else:
+                    results = await self.queue.stream_read_many(
+                        self._cursors(), count=self.count, timeout=self.block_ms / 1000
+                    )
+            except redis.RedisError as e:
+                logger.error(f"读取人工客服消息流失败: {e}")
+                metrics.incr("dispatcher.errors")
+                await asyncio.sleep(DISPATCHER_RETRY_DELAY)
+                continue
+            except Exception as e:
+                # 分发任务由本进程的所有会话共用，任何异常都不能让它退出
+                logger.error(f"分发人工客服消息出错: {e}", exc_info=True)
+                metrics.incr("dispatcher.errors")
+                await asyncio.sleep(DISPATCHER_RETRY_DELAY)
+                continue
+            for stream_name, entries in results.items():
+                for subscription in list(self._subscriptions.get(stream_name, ())):
+                    try:
+                        subscription._route(entries)
+                    except Exception as e:
+                        # 订阅的读取位置已经越过这批消息，出错的消息不会被反复读取
+                        logger.error(f"投递人工客服消息出错: {stream_name}, {e}", exc_info=True)
+                        metrics.incr("dispatcher.errors")
+                metrics.incr("dispatcher.delivered", len(entries))
+
+    async def _read_via_inbox(self) -> Dict[str, List[dict]]:
+        """
+        会话目录模式的一轮读取：同步目录登记（新订阅和心跳时把相应消息流加入待读取），
+        没有待读取的消息流时阻塞读取本工作进程的收件箱，然后一次非阻塞XREAD读取收到通知的消息流
+        """
+        directory = self.directory
+        streams = {
+            stream_name: {s.session_id for s in subscriptions if s.session_id}
+            for stream_name, subscriptions in self._subscriptions.items()
+        }
+        self._pending |= await directory.sync(streams)
+        if self._inbox_cursor is None:
+            self._inbox_cursor = await self.queue.stream_cursor_now()
+        if not self._pending:
+            inbox = directory.inbox_key()
+            notifications = await self.queue.stream_read_many(
+                {inbox: self._inbox_cursor}, count=self.count, timeout=self.block_ms / 1000
+            )
+            for entry in notifications.get(inbox, []):
+                # 先移动读取位置，无法解码的通知只跳过一次，不会被反复读取
+                self._inbox_cursor = entry["id"]
+                try:
+                    self._pending.add(entry["message"].body)
+                except Exception as e:
+                    logger.warning(f"无法解析收件箱通知 {entry['id']}: {e}")
+                    metrics.incr("dispatcher.errors")
+            metrics.incr("dispatcher.notifications", len(notifications.get(inbox, [])))
+        cursors = {name: cursor for name, cursor in self._cursors().items() if name in self._pending}
+        if not cursors:
+            self._pending.clear()
+            return {}
+        results = await self.queue.stream_read_many(cursors, count=self.count, block=False)
+        # 一次没有读完的消息流下一轮继续读取
+        self._pending = {name for name, entries in results.items() if len(entries) >= self.count}
+        return results
+
+    def _update_gauges(self):
+        metrics.set_gauge("dispatcher.streams", len(self._subscriptions))
+        metrics.set_gauge("dispatcher.subscriptions", sum(len(s) for s in self._subscriptions.values()))
@@ -0,0 +1,129 @@
+"""
+流式回答的token合并
+功能：把RAGFlow产生的细碎增量合并成较大的块再推送给前端，减少websocket帧数
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, List, Optional
+
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 两次推送之间的最小间隔（毫秒），0表示每个增量立即推送
+COALESCE_INTERVAL_MS = float(os.getenv('STREAM_COALESCE_INTERVAL_MS', 40))
+# 缓冲内容达到该字符数时不等间隔到期立即推送
+COALESCE_MAX_CHARS = int(os.getenv('STREAM_COALESCE_MAX_CHARS', 512))
+# 缓冲区上限（字符数），仅当前端长时间未完成推送时才会让上游读取暂停等待
+COALESCE_MAX_BUFFER_CHARS = int(os.getenv('STREAM_COALESCE_MAX_BUFFER_CHARS', 65536))
+
+
+class TokenCoalescer:
+    """
+    在上游增量和msg.stream_token之间做合并。
+
+    - push()只把增量放入缓冲区，由后台任务负责推送，上游读取不会等待前端；
+    - 距上次推送超过interval_ms，或缓冲内容达到max_chars时推送一次；
+      第一个增量不等待，保证首个token的延迟不变；
+    - 缓冲区超过max_buffer_chars时push()等待本次推送完成，避免内存无限增长。
+
+    用法：
+        async with TokenCoalescer(msg.stream_token) as coalescer:
+            async for delta in ...:
+                await coalescer.push(delta)
+    """
+    def __init__(
+        self,
+        sink: Callable[[str], Awaitable[None]],
+        interval_ms: float = COALESCE_INTERVAL_MS,
+        max_chars: int = COALESCE_MAX_CHARS,
+        max_buffer_chars: int = COALESCE_MAX_BUFFER_CHARS,
+    ):
+        self.sink = sink
+        self.interval = interval_ms / 1000
+        self.max_chars = max_chars
+        self.max_buffer_chars = max(max_buffer_chars, max_chars)
+        self.deltas_received = 0
+        self.frames_sent = 0
+        self._buffer: List[str] = []
+        self._size = 0
+        self._last_flush = float("-inf")
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "TokenCoalescer":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is asyncio.CancelledError:
+            self._task.cancel()
+        await self.close()
+
+    async def push(self, delta: str):
+        """放入一个增量"""
+        if self._error:
+            raise self._error
+        if not delta:
+            return
+        while self._size >= self.max_buffer_chars and not self._error:
+            self._space.clear()
+            await self._space.wait()
+        self._buffer.append(delta)
+        self._size += len(delta)
+        self.deltas_received += 1
+        if len(self._buffer) == 1 or self._size >= self.max_chars:
+            self._wakeup.set()
+
+    async def close(self):
+        """推送剩余内容并停止后台任务"""
+        self._closed = True
+        self._wakeup.set()
+        if self._task:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        metrics.incr("stream.deltas_received", self.deltas_received)
+        metrics.incr("stream.frames_sent", self.frames_sent)
+        metrics.incr("stream.frames_saved", self.deltas_received - self.frames_sent)
+        logger.debug(f"流式推送结束: 增量{self.deltas_received}个, 实际推送{self.frames_sent}帧")
+        if self._error:
+            raise self._error
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if not self._buffer:
+                    if self._closed:
+                        return
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                delay = self._last_flush + self.interval - loop.time()
+                if delay > 0 and self._size < self.max_chars and not self._closed:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._flush(loop)
+        except Exception as e:
+            self._error = e
+            self._space.set()
+
+    async def _flush(self, loop: asyncio.AbstractEventLoop):
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self._space.set()
+        self._last_flush = loop.time()
+        await self.sink(text)
+        self.frames_sent += 1
+        metrics.observe("stream.frame_chars", len(text))
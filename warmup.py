@@ -0,0 +1,119 @@
+"""
+服务启动预热
+功能：在后台解析AI助手、建立到RAGFlow和Redis的连接、补满预热会话池，
+并可选地为首页的快捷提问预先生成回答；完成后由/readyz报告就绪
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Optional
+
+import redis
+
+from answer_cache import AnswerCache, ANSWER_CACHE_ENABLED
+from message_queue import RedisQueue
+from ragflow_client import RAGFlowClient, CHAT_ASSISTANT_NAME
+from ragflow_stream import RAGFlowStreamParser
+from starters import STARTERS
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 是否在启动时为快捷提问预先生成回答（需启用回答缓存）
+WARMUP_PREGENERATE_STARTERS = os.getenv('WARMUP_PREGENERATE_STARTERS', 'true').lower() == 'true'
+# 预热整体超时时间（秒），超时后同样视为就绪，避免RAGFlow异常时实例永远无法接收流量
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 120))
+# 预先生成回答时使用的RAGFlow用户标识
+WARMUP_USER_ID = "warmup"
+
+
+class WarmupState:
+    """记录预热进度，供/readyz查询"""
+    def __init__(self):
+        self.ready = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 步骤名称 -> "ok" / "skipped" / 错误信息
+        self.steps: Dict[str, str] = {}
+
+    def to_dict(self) -> dict:
+        duration = None
+        if self.started_at and self.finished_at:
+            duration = round(self.finished_at - self.started_at, 3)
+        return {"ready": self.ready, "duration_seconds": duration, "steps": dict(self.steps)}
+
+
+# 进程级预热状态
+warmup_state = WarmupState()
+
+
+async def _step(name: str, coro):
+    """执行一个预热步骤，失败只记录，不影响后续步骤"""
+    try:
+        result = await coro
+        warmup_state.steps[name] = result if isinstance(result, str) else "ok"
+    except Exception as e:
+        warmup_state.steps[name] = f"error: {e}"
+        logger.warning(f"预热步骤{name}失败: {e}")
+
+
+async def _pregenerate_starters(client: RAGFlowClient, answer_cache: Optional[AnswerCache]) -> str:
+    # 未启用回答缓存时生成的回答没有人读取，不为每个快捷提问消耗一次RAGFlow回答
+    if not WARMUP_PREGENERATE_STARTERS or not ANSWER_CACHE_ENABLED or answer_cache is None:
+        return "skipped"
+    generated = 0
+    for starter in STARTERS:
+        question = starter["message"]
+        if await asyncio.to_thread(answer_cache.get, client.chat_id, question):
+            continue
+        # 每个问题使用独立会话，避免回答受前一个问题的上下文影响
+        session_id = await client.create_chat_session(f"chaint_session:{WARMUP_USER_ID}")
+        parser = RAGFlowStreamParser()
+        async for _ in client.iter_chat_completion(question, session_id, WARMUP_USER_ID, parser):
+            pass
+        if parser.finished and parser.answer:
+            await asyncio.to_thread(
+                answer_cache.set, client.chat_id, question, parser.answer, parser.referenced_docs()
+            )
+            generated += 1
+    return f"ok: generated {generated}/{len(STARTERS)}"
+
+
+async def _run_steps(
+    redis_client: Optional[redis.Redis], answer_cache: Optional[AnswerCache], redis_queue: Optional[RedisQueue]
+):
+    client = RAGFlowClient(
+        os.getenv('RAGFLOW_API_KEY'), os.getenv('RAGFLOW_BASE_URL'), answer_cache=answer_cache
+    )
+    # 解析助手的同时完成DNS解析和TCP/TLS握手，连接留在共享连接池中
+    await _step("resolve_assistant", client.get_chat_id(CHAT_ASSISTANT_NAME))
+    if redis_client is not None:
+        await _step("redis", asyncio.to_thread(redis_client.ping))
+    else:
+        warmup_state.steps["redis"] = "skipped"
+    if redis_queue is not None:
+        # 把队列索引建立之前已存在的人工客服消息队列登记到索引中（SCAN，不阻塞Redis）
+        await _step("queue_registry", asyncio.to_thread(
+            redis_queue.rebuild_registry, f"{os.getenv('IT_ENVIRONMENT')}:rocket.chat_session:"
+        ))
+    if client.chat_id:
+        await _step("session_pool", client.prefill_session_pool() or asyncio.sleep(0))
+        await _step("starter_answers", _pregenerate_starters(client, answer_cache))
+
+
+async def run_warmup(
+    redis_client: Optional[redis.Redis], answer_cache: Optional[AnswerCache] = None, redis_queue: Optional[RedisQueue] = None
+):
+    """执行全部预热步骤，结束后把实例标记为就绪"""
+    warmup_state.started_at = time.monotonic()
+    logger.info("开始启动预热")
+    try:
+        await asyncio.wait_for(_run_steps(redis_client, answer_cache, redis_queue), WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"启动预热超过{WARMUP_TIMEOUT}秒未完成，直接标记为就绪")
+        warmup_state.steps["timeout"] = f"exceeded {WARMUP_TIMEOUT}s"
+    finally:
+        warmup_state.finished_at = time.monotonic()
+        warmup_state.ready = True
+        metrics.set_gauge("warmup.duration_seconds", warmup_state.finished_at - warmup_state.started_at)
+        logger.info(f"启动预热完成: {warmup_state.to_dict()}")
@@ -0,0 +1,119 @@
+"""
+Rocket.Chat webhook消息的缓冲写入
+功能：webhook处理函数只校验和入缓冲区后立即返回，由一个后台写入任务批量取出消息，
+按消息流分组后在一次Redis往返中写入；缓冲区有上限，写满时webhook返回503和Retry-After，
+让Rocket.Chat稍后重试，客服集中回复或Rocket.Chat重试风暴不会拖慢同一事件循环上的Chainlit会话
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from resilience import retry_async
+from session_directory import SessionDirectory
+from metrics import metrics
+from logger_config import setup_logger
+logger = setup_logger(__name__)
+
+# 缓冲区最多容纳的消息数，写满后webhook返回503
+WEBHOOK_BUFFER_SIZE = int(os.getenv('WEBHOOK_BUFFER_SIZE', 1000))
+# 每次写入Redis的最大消息数
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 100))
+# 缓冲区写满时建议Rocket.Chat重试的等待时间（秒），作为Retry-After响应头
+WEBHOOK_RETRY_AFTER = int(os.getenv('WEBHOOK_RETRY_AFTER', 5))
+# 写入Redis失败时的重试次数，全部失败后丢弃该批消息并记录错误
+WEBHOOK_WRITE_ATTEMPTS = int(os.getenv('WEBHOOK_WRITE_ATTEMPTS', 3))
+
+
+class WebhookIngestor:
+    """
+    有界缓冲区 + 单个批量写入任务。
+
+    用法：
+        ingestor = WebhookIngestor(async_queue)
+        ingestor.start()                      # 服务启动时
+        if not ingestor.submit(stream_name, message):
+            ...                               # 缓冲区已满，返回503
+        await ingestor.close()                # 服务关闭时，写完缓冲区中剩余的消息
+    """
+    def __init__(self, queue, buffer_size: int = WEBHOOK_BUFFER_SIZE, batch_size: int = WEBHOOK_BATCH_SIZE,
+                 write_attempts: int = WEBHOOK_WRITE_ATTEMPTS, directory: Optional[SessionDirectory] = None):
+        self.queue = queue
+        # 启用会话目录时，写入回复的同时通知负责这些消息流的工作进程
+        self.directory = directory
+        self.batch_size = batch_size
+        self.write_attempts = write_attempts
+        self._buffer: "asyncio.Queue[Tuple[str, Any, float]]" = asyncio.Queue(maxsize=buffer_size)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, stream_name: str, message: Any) -> bool:
+        """放入缓冲区，不等待Redis；缓冲区已满时返回False"""
+        try:
+            self._buffer.put_nowait((stream_name, message, time.perf_counter()))
+        except asyncio.QueueFull:
+            metrics.incr("webhook.rejected")
+            return False
+        metrics.incr("webhook.accepted")
+        metrics.set_gauge("webhook.buffer_depth", self._buffer.qsize())
+        return True
+
+    async def close(self):
+        """等待缓冲区中剩余的消息写入Redis，然后停止写入任务"""
+        if self._task is None:
+            return
+        if not self._task.done():
+            await self._buffer.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            batch = [await self._buffer.get()]
+            # 上一批写入期间到达的消息在这一批中一起写入
+            while len(batch) < self.batch_size and not self._buffer.empty():
+                batch.append(self._buffer.get_nowait())
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                logger.error(f"写入人工客服消息出错: {e}", exc_info=True)
+                metrics.incr("webhook.dropped", len(batch))
+            finally:
+                for _ in batch:
+                    self._buffer.task_done()
+
+    async def _flush(self, batch: List[Tuple[str, Any, float]]):
+        if not batch:
+            return
+        streams: Dict[str, List[Any]] = {}
+        for stream_name, message, _ in batch:
+            streams.setdefault(stream_name, []).append(message)
+        start = time.perf_counter()
+
+        async def write():
+            notify = await self.directory.notifications(streams) if self.directory is not None else None
+            await self.queue.enqueue_streams(streams, notify=notify)
+
+        try:
+            await retry_async(write, attempts=self.write_attempts, retry_on=(redis.RedisError,))
+        except redis.RedisError as e:
+            logger.error(f"人工客服消息写入Redis失败，丢弃{len(batch)}条消息: {e}")
+            metrics.incr("webhook.dropped", len(batch))
+            return
+        finished = time.perf_counter()
+        metrics.observe("webhook.flush_seconds", finished - start)
+        metrics.observe("webhook.batch_size", len(batch))
+        metrics.incr("webhook.written", len(batch))
+        metrics.set_gauge("webhook.buffer_depth", self._buffer.qsize())
+        for _, _, received in batch:
+            metrics.observe("webhook.ingest_latency_seconds", finished - received)
+        logger.debug(f"写入{len(batch)}条人工客服消息到{len(streams)}个消息流，耗时{finished - start:.3f}秒")
@@ -1,14 +1,28 @@
 ﻿from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse
+import asyncio
 import uvicorn
 import json
+import logging
 import os
+import redis
 import chainlit as cl
 from chainlit.utils import mount_chainlit
 
 # import session_utils
 # from chainlit_ragflow_streaming import message_queues, message_queues_lock
 
-from message_queue import RedisQueue
+from queue_backend import create_queue, create_async_queue
+from webhook_ingest import WebhookIngestor, WEBHOOK_RETRY_AFTER
+from stream_dispatcher import local_bus
+from session_directory import create_session_directory
+from message_codec import StreamMessage
+from ragflow_client import close_http_session
+from metrics import metrics
+from redis_pool import pool_stats, close_async_pools
+from answer_cache import AnswerCache, ANSWER_CACHE_ENABLED
+from warmup import run_warmup, warmup_state
+from retention import RetentionSweeper, run_retention_loop
 from pydantic import BaseModel
 
 class MessageRequest(BaseModel):
@@ -21,9 +35,20 @@ from logger_config import setup_logger
 logger = setup_logger(__name__)
 
 app = FastAPI()
-redis_queue = RedisQueue()
+redis_queue = create_queue()
+# 未启用回答缓存或使用进程内队列（QUEUE_BACKEND=memory，没有Redis连接）时不使用回答缓存
+answer_cache = AnswerCache(redis_queue.client) if ANSWER_CACHE_ENABLED and redis_queue.client is not None else None
 # 存储会话映射: Rocket.Chat用户ID -> Chainlit会话ID
 session_mapping = {}
+# 启动预热任务（保存引用，避免任务被垃圾回收）
+warmup_task = None
+# 定期清理过期数据：Redis后端补设过期时间并清理队列索引；进程内队列删除已过期的消息流和索引
+retention_sweeper = RetentionSweeper(redis_queue.client) if redis_queue.client is not None else redis_queue.store
+retention_task = None
+# 人工客服回复先进入有界缓冲区，由后台任务批量写入消息流，webhook处理函数不等待Redis；
+# 启用会话目录时同时通知负责该会话的工作进程（可能在其他节点）
+async_queue = create_async_queue()
+webhook_ingestor = WebhookIngestor(async_queue, directory=create_session_directory(async_queue))
 
 @app.post("/rocketchat-webhook")
 async def rocketchat_webhook(request: Request):
@@ -50,7 +75,9 @@ async def rocketchat_webhook(request: Request):
         logger.error(f"Unexpected error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="An unexpected error occurred")
         
-    logger.info(f"【debug】收到Rocket.Chat webhook: {json.dumps(data, ensure_ascii=False)}")
+    # 完整请求体只在DEBUG级别记录，客服集中回复时不为每条消息序列化和写入整个请求体
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"【debug】收到Rocket.Chat webhook: {json.dumps(data, ensure_ascii=False)}")
 
     # 验证webhook令牌（从body中获取token）
     token = data.get("token")
@@ -69,20 +96,8 @@ async def rocketchat_webhook(request: Request):
     message_id = data.get("message_id", "")
     timestamp = data.get("timestamp", "")
     # 添加调试日志
-    logger.info(f"【debug】提取消息: sender（Support agent）={sender_username}, content={content[:50]}, room_id={room_id}, message_id={message_id}, timestamp={timestamp}")
+    logger.debug(f"【debug】提取消息: sender（Support agent）={sender_username}, content={content[:50]}, room_id={room_id}, message_id={message_id}, timestamp={timestamp}")
 
-    # 验证Redis连接并检查队列
-    try:
-        # 检查Redis连接
-        redis_queue.client.ping()
-        logger.info("【debug】Redis连接正常")
-        # 打印Redis实例基本信息
-        logger.debug(f"【debug】Redis连接信息 - IP: {redis_queue.host}, 端口: {redis_queue.port}, 数据库索引: {redis_queue.db}")
-
-    except Exception as e:
-        logger.error(f"【debug】Redis连接失败: {str(e)}")
-        raise HTTPException(status_code=500, detail="Redis connection failed")
-        
     # 过滤掉系统消息和自动转发的消息
     if "[CHAINLIT_USER_ID:" in content or "[HUMAN_SESSION]" in content:
         logger.info(f"【debug】过滤掉自动转发的消息: {content}")
@@ -96,13 +111,18 @@ async def rocketchat_webhook(request: Request):
     # if queue_type != 'list':
     #     logger.warning(f"【debug】队列 {queue_name} 不是列表类型，实际类型: {queue_type}")
     #     raise HTTPException(status_code=500, detail=f"Queue {queue_name} is not a list type")
-    if redis_queue.qsize(queue_name) == 0 and queue_name not in redis_queue.get_all_queues(): 
-        logger.warning(f"【debug】队列 {queue_name} 不存在，将创建新队列")
-    # 消息入队，同时设置队列仅保留最近1000条消息，避免内存溢出
-    redis_queue.enqueue_stream(queue_name, agent_reply)
-    # 入队后验证
-    new_size = redis_queue.qsize(queue_name)
-    logger.info(f"【debug】消息入队成功，队列 {queue_name} 当前大小: {new_size}, 消息内容: {agent_reply}")
+    # 放入缓冲区后立即返回，由后台任务批量写入消息流（仅保留最近1000条消息、刷新过期时间、登记队列）；
+    # 缓冲区已满时返回503，Rocket.Chat按Retry-After稍后重试
+    message = StreamMessage(agent_reply, sender=sender_username, message_id=message_id)
+    if not webhook_ingestor.submit(queue_name, message):
+        logger.warning(f"【debug】webhook缓冲区已满，拒绝消息: 队列 {queue_name}, message_id={message_id}")
+        raise HTTPException(
+            status_code=503, detail="Service temporarily unavailable",
+            headers={"Retry-After": str(WEBHOOK_RETRY_AFTER)},
+        )
+    # 目标会话在本工作进程时直接投递，不等待写入Redis和分发器读取；之后从Redis读到的同一条消息按message_id去重
+    local_sessions = local_bus.publish(queue_name, message)
+    logger.debug(f"【debug】消息已放入缓冲区，队列 {queue_name}, 本地投递会话数: {local_sessions}, 消息内容: {agent_reply}")
     return {"status": "success"}
     # logger.info(f"【debug】消息入队成功，队列名称： {queue_name} 当前大小: {redis_queue.qsize(queue_name)}")
 
@@ -135,6 +155,60 @@ async def rocketchat_webhook(request: Request):
     logger.info(f"【debug】准备入队消息到队列 {queue_name}, 会话ID: {chainlit_session_id}")
     """
 
+@app.post("/answer-cache/invalidate")
+async def invalidate_answer_cache(request: Request):
+    """
+    知识库内容变化后清除回答缓存。
+
+    请求体：{"token": "...", "chat_id": "..."}，chat_id为空时清除所有助手的缓存。
+    """
+    data = await request.json()
+    expected_token = os.getenv("ANSWER_CACHE_INVALIDATE_TOKEN")
+    if not expected_token or data.get("token") != expected_token:
+        logger.warning("【debug】回答缓存失效请求令牌验证失败")
+        raise HTTPException(status_code=403, detail="Invalid token")
+    if answer_cache is None:
+        return {"enabled": False}
+    # SCAN+DEL在线程中执行，不阻塞与Chainlit共用的事件循环
+    deleted = await asyncio.to_thread(answer_cache.invalidate, data.get("chat_id"))
+    return {"status": "success", "deleted": deleted}
+
+@app.get("/metrics")
+async def get_metrics():
+    """输出进程内运行指标（含Redis连接池使用情况）"""
+    return {**metrics.snapshot(), "redis_pools": pool_stats()}
+
+@app.get("/retention")
+async def retention():
+    """最近一次数据清理的结果：各前缀的键数量、内存占用和补设过期时间的键数（进程内队列为各类键数量和删除数）"""
+    if retention_sweeper is None:
+        return {"enabled": False}
+    return {"enabled": True, "report": retention_sweeper.last_report}
+
+@app.get("/readyz")
+async def readyz():
+    """就绪检查：启动预热完成前返回503，滚动发布时不把流量导向冷实例"""
+    status_code = 200 if warmup_state.ready else 503
+    return JSONResponse(status_code=status_code, content=warmup_state.to_dict())
+
+@app.on_event("startup")
+async def startup():
+    """在后台执行启动预热，不阻塞服务启动"""
+    global warmup_task, retention_task
+    webhook_ingestor.start()
+    warmup_task = asyncio.create_task(run_warmup(redis_queue.client, answer_cache, redis_queue))
+    if retention_sweeper is not None:
+        retention_task = asyncio.create_task(run_retention_loop(retention_sweeper))
+
+@app.on_event("shutdown")
+async def shutdown():
+    """写完缓冲区中的webhook消息并停止后台清理，关闭共享的RAGFlow HTTP连接池和Redis异步连接池"""
+    await webhook_ingestor.close()
+    if retention_task is not None:
+        retention_task.cancel()
+    await close_http_session()
+    await close_async_pools()
+
 # 挂载Chainlit应用
 mount_chainlit(app=app, target="chainlit_ragflow_streaming.py", path="/")
 